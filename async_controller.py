@@ -0,0 +1,122 @@
+"""Asynchronous heliostat controllers.
+
+AsyncStringPotController and AsyncCompassController carry out the same
+protocol as heliostat's StringPotController and CompassController --
+the operations of StringPotProtocol and CompassProtocol -- but never
+block: the serial port is non-blocking and read by the event loop, and
+every wait is a sleep on the loop, so one loop can drive several
+mirrors alongside other work. Written against trollius, the asyncio
+backport for Python 2: stop(), azimuth(), elevation() and move_to()
+return coroutines, to be run with ``yield From``.
+"""
+
+import serial
+import sys
+import types
+
+import trollius as asyncio
+from trollius import From, Return
+
+from compensation import COMPENSATION_FILE
+from heliostat import (StringPotProtocol, CompassProtocol, Result, system_clock,
+                       BAUD_RATE, WRITE, READ, POLL, WRITE_TIMEOUT)
+
+import logging
+logger = logging.getLogger(__name__)
+
+class AsyncStringPotController(StringPotProtocol):
+    """The protocol on a non-blocking serial port, run on an event
+    loop. Call start() before anything else; it stops the mirror, as
+    the blocking controller does on construction.
+
+    Operations on one port are run one at a time. The clock should
+    keep time with the loop, as the system clock does. The abort
+    event, if set, is an asyncio.Event.
+    """
+    def __init__(self, device='/dev/ttyUSB0', telemetry=None, clock=system_clock, loop=None):
+        super(AsyncStringPotController, self).__init__(telemetry, clock)
+        self.device = device
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.port = serial.Serial(device, baudrate=BAUD_RATE, timeout=0)
+        self.lock = asyncio.Lock(loop=self.loop)
+        self.incoming = bytearray()     # Read from the port, not yet asked for
+        self._data_ready = None
+        self.loop.add_reader(self.port.fileno(), self._on_readable)
+
+    def start(self):
+        return self.stop()
+
+    def close(self):
+        self.loop.remove_reader(self.port.fileno())
+        self.port.close()
+
+    def _on_readable(self):
+        self.incoming.extend(self.port.read(self.port.inWaiting()))
+        if self._data_ready is not None and not self._data_ready.done():
+            self._data_ready.set_result(True)
+
+    @asyncio.coroutine
+    def run(self, operation):
+        """Carry out a protocol operation and return its result."""
+        with (yield From(self.lock)):
+            result = yield From(self._run(operation))
+        raise Return(result)
+
+    @asyncio.coroutine
+    def _run(self, operation):
+        value, error = None, None
+        while True:
+            try:
+                step = operation.throw(*error) if error else operation.send(value)
+            except Result as result:
+                raise Return(result.value)
+            except StopIteration:
+                raise Return(None)
+            value, error = None, None
+            try:
+                if isinstance(step, types.GeneratorType):
+                    value = yield From(self._run(step))
+                else:
+                    value = yield From(self._do(*step))
+            except Exception:
+                error = sys.exc_info()
+
+    @asyncio.coroutine
+    def _do(self, step, argument):
+        if step == WRITE:
+            self.port.write(argument)
+        elif step == READ:
+            data = yield From(self._read(argument, WRITE_TIMEOUT))
+            raise Return(data)
+        elif step == POLL and self.abort is not None:
+            try:
+                yield From(asyncio.wait_for(self.abort.wait(), argument, loop=self.loop))
+            except asyncio.TimeoutError:
+                pass
+        else:
+            yield From(asyncio.sleep(argument, loop=self.loop))
+
+    @asyncio.coroutine
+    def _read(self, size, timeout):
+        """Up to size bytes, waiting up to timeout seconds for them
+        all, as a blocking read with that timeout would.
+        """
+        deadline = self.loop.time() + timeout
+        while len(self.incoming) < size:
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                break
+            self._data_ready = asyncio.Future(loop=self.loop)
+            yield From(asyncio.wait([self._data_ready], timeout=remaining, loop=self.loop))
+            self._data_ready = None
+        data = bytes(self.incoming[:size])
+        del self.incoming[:size]
+        raise Return(data)
+
+class AsyncCompassController(CompassProtocol, AsyncStringPotController):
+    """CompassProtocol on a non-blocking serial port."""
+    def __init__(self, device='/dev/ttyUSB0', az_interp=None, el_interp=None,
+                 telemetry=None, clock=system_clock, calibration=None,
+                 compensation=COMPENSATION_FILE, loop=None):
+        self._load_mappings(az_interp, el_interp, calibration, compensation)
+        super(AsyncCompassController, self).__init__(device, telemetry, clock, loop)
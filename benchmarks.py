@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmarks for the control and finder hot paths.
+
+Every result is a cost (seconds per operation, writes per send, ...),
+so lower is better. Save a run with --save and compare a later run
+against it with --compare; anything more than --threshold slower is
+reported as a regression and makes the script exit non-zero.
+"""
+
+from astral import City
+import argparse
+import datetime
+import json
+import platform
+import sys
+import time
+import timeit
+
+from heliostat import Encoder, Decoder, StringPotController, az_interp, SPEED_NORMAL
+from simulator import SimulatedController
+from solar_finders import AstralSolarFinder, CorrectedAstralSolarFinder, EmpiricalSolarFinder
+from track_sun import jeffs_data
+
+import logging
+logger = logging.getLogger(__name__)
+
+REPEAT = 5                      # Timing runs per micro-benchmark (best is kept)
+THRESHOLD = 0.25                # Fractional slowdown reported as a regression
+BATCH_MINUTES = 1440            # Timestamps in a batch find (one day at one per minute)
+DEVICE_MOVES = ((520, 60), (480, 45), (500, 50))    # String-pot azimuth, elevation
+
+def per_call(func, number):
+    """Best seconds per call of func over REPEAT runs of number calls."""
+    return min(timeit.repeat(func, repeat=REPEAT, number=number)) / number
+
+def protocol_benchmarks():
+    encoder, decoder = Encoder(), Decoder()
+    response = decoder.pack(0x41, 0x41, 0x41, 0, 50, 600, 470, 500)
+    return { 'encoder.azimuth': per_call(lambda: encoder.azimuth(500, SPEED_NORMAL), 100000),
+             'encoder.stop': per_call(encoder.stop, 100000),
+             'decoder.decode': per_call(lambda: decoder.decode(response), 100000),
+             'interp.forward': per_call(lambda: az_interp.forward(180), 100000),
+             'interp.reverse': per_call(lambda: az_interp.reverse(555), 100000) }
+
+def finder_benchmarks():
+    upland = City(("Upland", "USA", "40°27'22\"N", "85°29'43\"W", "US/Eastern"))
+    noon = datetime.datetime(2012, 8, 21, 12, 0)
+    batch = [noon.replace(hour=0) + datetime.timedelta(minutes=minute)
+             for minute in range(BATCH_MINUTES)]
+    local_batch = [upland.tz.localize(when) for when in batch]
+
+    astral = AstralSolarFinder(upland)
+    corrected = CorrectedAstralSolarFinder(upland)
+    empirical = EmpiricalSolarFinder(jeffs_data)
+
+    return { 'astral.find': per_call(astral.find, 1000),
+             'astral.find_many': per_call(lambda: astral.find_many(local_batch), 10) / BATCH_MINUTES,
+             'corrected.find': per_call(lambda: corrected.find(noon), 1000),
+             'corrected.find_many': per_call(lambda: corrected.find_many(batch), 10) / BATCH_MINUTES,
+             'empirical.find': per_call(lambda: empirical.find(noon), 1000),
+             'empirical.find_many': per_call(lambda: empirical.find_many(batch), 10) / BATCH_MINUTES }
+
+def device_benchmarks():
+    """Moves against the simulated controller: writes per send and
+    seconds to settle per move.
+    """
+    simulator = SimulatedController(seed=0)
+    try:
+        controller = StringPotController(simulator.device)
+        controller.writes = controller.sends = 0
+        started = time.time()
+        for azimuth, elevation in DEVICE_MOVES:
+            controller.azimuth(azimuth)
+            controller.elevation(elevation)
+        settle = (time.time() - started) / (2 * len(DEVICE_MOVES))
+        writes_per_send = controller.writes / float(controller.sends)
+        controller.port.close()
+    finally:
+        simulator.close()
+    return { 'device.writes_per_send': writes_per_send,
+             'device.settle_seconds': settle }
+
+def compare(results, baseline, threshold):
+    """Print each result against the baseline; return the regressions."""
+    regressions = [ ]
+    for name in sorted(results):
+        if name not in baseline:
+            print "{0:28s} {1:12.4g}  (new)".format(name, results[name])
+            continue
+        ratio = results[name] / baseline[name] if baseline[name] else float('inf')
+        if ratio > 1 + threshold:
+            verdict = 'REGRESSION'
+            regressions.append(name)
+        elif ratio < 1 - threshold:
+            verdict = 'improved'
+        else:
+            verdict = ''
+        print "{0:28s} {1:12.4g} {2:12.4g} {3:7.2f}x {4}".format(name, results[name],
+                                                                baseline[name], ratio, verdict)
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the heliostat hot paths')
+    parser.add_argument('--save', help='write results to this JSON file')
+    parser.add_argument('--compare', help='compare results with this JSON file')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='fractional slowdown that counts as a regression')
+    parser.add_argument('--no-device', dest='device', action='store_false',
+                        help='skip the (slow) simulated device benchmarks')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = { }
+    results.update(protocol_benchmarks())
+    results.update(finder_benchmarks())
+    if args.device:
+        results.update(device_benchmarks())
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+    else:
+        for name in sorted(results):
+            print "{0:28s} {1:12.4g}".format(name, results[name])
+        regressions = [ ]
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({ 'when': datetime.datetime.now().isoformat(),
+                        'python': platform.python_version(),
+                        'results': results }, f, indent=4, sort_keys=True)
+
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,128 @@
+"""Fit (or keep fitting) the compass <-> string-pot calibration.
+
+Each run carries on from the calibration file, fitting surveyed
+points given with --points (lines of "AZ|EL,degrees,reading").
+
+The controller also reports a compass azimuth, but it is too far off
+to be trusted (the Decoder doesn't even log it, and the simulator
+sends 0). Only with --compass are new telemetry records (those after
+the last one already fitted) folded into the azimuth fit, pairing that
+compass azimuth with the string-pot reading; with --follow as well it
+keeps reading the telemetry store as the tracker writes it.
+
+A new calibration starts from PRIOR_POINTS points on the current
+LinearInterp mappings. The controllers only use a calibration file
+when given one (e.g. heliostatd --calibration).
+"""
+
+from __future__ import division
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+from calibration import (Calibration, PolynomialModel, PiecewiseLinearModel,
+                         load_calibrations, save_calibrations, CALIBRATION_FILE)
+from heliostat import (az_interp, el_interp, COMPASS_AZIMUTH_MIN, COMPASS_AZIMUTH_MAX,
+                       ELEVATION_MIN, ELEVATION_MAX)
+from telemetry import TelemetryStore, TELEMETRY_FILE
+
+import logging
+logger = logging.getLogger(__name__)
+
+PRIOR_POINTS = 8                # Points from the old mapping a new fit starts from
+FOLLOW_INTERVAL = 60            # Seconds between looks at the telemetry with --follow
+AXES = { 'AZ': 'azimuth', 'EL': 'elevation' }
+
+def new_calibrations(model):
+    """Calibrations for both axes, starting from az_interp and el_interp."""
+    calibrations = { }
+    for axis, interp, low, high in (('azimuth', az_interp, COMPASS_AZIMUTH_MIN, COMPASS_AZIMUTH_MAX),
+                                    ('elevation', el_interp, ELEVATION_MIN, ELEVATION_MAX)):
+        calibration = Calibration(interp.name, model(), low, high)
+        degrees = np.linspace(low, high, PRIOR_POINTS)
+        calibration.add_many(degrees, interp.slope * degrees + interp.intercept)
+        calibrations[axis] = calibration
+    return calibrations
+
+def add_points(calibrations, path):
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            which, degrees, reading = line.split(',')
+            if which not in AXES:
+                raise ValueError("Invalid axis '{0}'".format(which))
+            calibrations[AXES[which]].add(float(degrees), float(reading))
+
+def add_telemetry(calibration, store):
+    """Fit the azimuth calibration to the records in store that it
+    hasn't seen; return how many were used and their mean absolute
+    error (in string-pot units) before each was fitted.
+    """
+    records = store.read(start=calibration.until)
+    if calibration.until is not None:
+        records = records[records['time'] > calibration.until]
+    usable = ((records['compass_azimuth'] >= calibration.low) &
+              (records['compass_azimuth'] <= calibration.high) &
+              (records['azimuth'] > 0))
+    records = records[usable]
+
+    total_error = 0.0
+    for when, degrees, reading in zip(records['time'], records['compass_azimuth'],
+                                      records['azimuth']):
+        total_error += abs(calibration.add(float(degrees), float(reading), float(when)))
+    return len(records), total_error / len(records) if len(records) else 0.0
+
+def report(calibrations):
+    for axis in sorted(calibrations):
+        calibration = calibrations[axis]
+        print "{0:10s} {1:6d} samples  {2:.0f} -> {3:.1f}  {4:.0f} -> {5:.1f}".format(
+            axis, calibration.count, calibration.low, calibration.predict(calibration.low),
+            calibration.high, calibration.predict(calibration.high))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fit the compass <-> string-pot calibration')
+    parser.add_argument('--file', default=CALIBRATION_FILE, help='calibration file')
+    parser.add_argument('--telemetry', default=TELEMETRY_FILE, help='telemetry store (with --compass)')
+    parser.add_argument('--points', help='surveyed points to fit (AZ|EL,degrees,reading)')
+    parser.add_argument('--reset', action='store_true', help='start a new fit')
+    parser.add_argument('--degree', type=int, default=1, help='degree of a new polynomial fit')
+    parser.add_argument('--knots', type=float, nargs='+',
+                        help='fit a new piecewise linear model bending at these degrees')
+    parser.add_argument('--compass', action='store_true',
+                        help="fit the controller's compass azimuth readings from the telemetry")
+    parser.add_argument('--follow', action='store_true', help='keep fitting new telemetry')
+    args = parser.parse_args()
+
+    if args.reset or not os.path.exists(args.file):
+        if args.knots:
+            model = lambda: PiecewiseLinearModel(args.knots)
+        else:
+            model = lambda: PolynomialModel(args.degree)
+        calibrations = new_calibrations(model)
+    else:
+        calibrations = load_calibrations(args.file)
+
+    if args.points:
+        add_points(calibrations, args.points)
+
+    store = None
+    if args.compass:
+        logger.warning("Fitting the controller's compass azimuth, which is known to be unreliable")
+        store = TelemetryStore(args.telemetry, mode='r')
+    elif args.follow:
+        parser.error("--follow needs --compass")
+    while True:
+        if store is not None:
+            count, error = add_telemetry(calibrations['azimuth'], store)
+            logger.info("Fitted %d telemetry records, mean error %.2f", count, error)
+        save_calibrations(args.file, calibrations)
+        if not args.follow or store is None:
+            break
+        time.sleep(FOLLOW_INTERVAL)
+
+    report(calibrations)
@@ -0,0 +1,209 @@
+"""Online calibration of the compass <-> string-pot mappings.
+
+A Calibration maps compass degrees to string-pot readings, as
+LinearInterp does, but with a model fitted by recursive least squares:
+each (degrees, reading) sample updates the fit in constant time and
+space, however many samples came before, so it can follow live
+telemetry indefinitely. Models are polynomials or continuous piecewise
+linear functions of the (normalised) angle.
+
+Fitted calibrations are saved as JSON, state and all, so a controller
+loads them at startup without refitting and later samples carry on
+where the fit left off.
+"""
+
+from __future__ import division
+
+import json
+import os
+
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+CALIBRATION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'calibration.json')
+VERSION = 1
+
+FORGETTING = 1.0                # Weight kept by the fit so far at each new sample (1 keeps all)
+INITIAL_COVARIANCE = 1e6        # Uncertainty of the (zero) initial fit
+REVERSE_STEP = 0.05             # Degrees between entries of the table reverse() looks up
+
+class PolynomialModel(object):
+    """Reading as a polynomial in the angle."""
+    kind = 'polynomial'
+
+    def __init__(self, degree=1):
+        self.degree = degree
+        self.size = degree + 1
+
+    def features(self, u):
+        return np.array([u ** power for power in range(self.size)])
+
+    def to_dict(self):
+        return { 'kind': self.kind, 'degree': self.degree }
+
+class PiecewiseLinearModel(object):
+    """Reading as a continuous, piecewise linear function of the angle,
+    bending at each of knots (in the same units as the angle).
+    """
+    kind = 'piecewise'
+
+    def __init__(self, knots=()):
+        self.knots = [float(knot) for knot in knots]
+        self.size = len(self.knots) + 2
+
+    def features(self, u):
+        return np.array([1.0, u] + [max(0.0, u - knot) for knot in self.knots])
+
+    def to_dict(self):
+        return { 'kind': self.kind, 'knots': self.knots }
+
+MODELS = dict((model.kind, model) for model in (PolynomialModel, PiecewiseLinearModel))
+
+def model_from_dict(d):
+    d = dict(d)
+    kind = d.pop('kind')
+    if kind not in MODELS:
+        raise ValueError("Unknown kind of calibration model '{0}'".format(kind))
+    return MODELS[kind](**d)
+
+class RecursiveLeastSquares(object):
+    """Least squares fit of y = theta . phi, updated one sample at a time."""
+    def __init__(self, size, forgetting=FORGETTING, covariance=INITIAL_COVARIANCE):
+        self.theta = np.zeros(size)
+        self.covariance = np.eye(size) * covariance
+        self.forgetting = forgetting
+        self.count = 0
+
+    def update(self, phi, y):
+        """Fold in one sample; return its error before the update."""
+        p_phi = self.covariance.dot(phi)
+        gain = p_phi / (self.forgetting + phi.dot(p_phi))
+        error = y - phi.dot(self.theta)
+        self.theta = self.theta + gain * error
+        self.covariance = (self.covariance - np.outer(gain, p_phi)) / self.forgetting
+        self.count += 1
+        return error
+
+    def predict(self, phi):
+        return phi.dot(self.theta)
+
+class Calibration(object):
+    """Fitted mapping from compass degrees to string-pot readings, used
+    wherever a LinearInterp is. Angles are normalised to [-1, 1] over
+    low to high (the range calibrated), which keeps the fit well
+    conditioned; knots of a piecewise model are in degrees.
+    """
+    def __init__(self, name, model, low, high, forgetting=FORGETTING):
+        self.name = name
+        self.model = model
+        self.low = float(low)
+        self.high = float(high)
+        self.fit = RecursiveLeastSquares(model.size, forgetting)
+        self.until = None       # Time of the latest sample, for carrying on from telemetry
+        self._table = None      # Readings at REVERSE_STEP across the range, for reverse()
+
+        if isinstance(model, PiecewiseLinearModel):
+            model.knots = [self._normalise(knot) for knot in model.knots]
+
+    def _normalise(self, degrees):
+        return (2 * degrees - self.low - self.high) / (self.high - self.low)
+
+    def add(self, degrees, reading, when=None):
+        """Fit one sample of the reading at degrees (taken at time
+        when); return how far off the fit was before it.
+        """
+        error = self.fit.update(self.model.features(self._normalise(degrees)), reading)
+        self._table = None
+        if when is not None:
+            self.until = when if self.until is None else max(self.until, when)
+        return error
+
+    def add_many(self, degrees, readings, times=None):
+        times = times if times is not None else [None] * len(degrees)
+        for value, reading, when in zip(degrees, readings, times):
+            self.add(float(value), float(reading), None if when is None else float(when))
+
+    @property
+    def count(self):
+        return self.fit.count
+
+    def predict(self, degrees):
+        return self.fit.predict(self.model.features(self._normalise(degrees)))
+
+    def forward(self, value):
+        rtn = int(self.predict(value))
+        logger.debug("{0} forward {1} -> {2}".format(self.name, value, rtn))
+        return rtn
+
+    def inverse(self, reading):
+        """Degrees at which the fit gives reading (a float)."""
+        if self._table is None:
+            degrees = np.arange(self.low, self.high + REVERSE_STEP, REVERSE_STEP)
+            readings = np.array([self.predict(value) for value in degrees])
+            if readings[-1] < readings[0]:
+                degrees, readings = degrees[::-1], readings[::-1]
+            if np.any(np.diff(readings) <= 0):
+                raise ValueError("{0} calibration isn't monotonic over {1}-{2}".format(
+                    self.name, self.low, self.high))
+            self._table = (degrees, readings)
+
+        # Straight on beyond the ends of the table.
+        degrees, readings = self._table
+        if reading < readings[0]:
+            ends = 0, 1
+        elif reading > readings[-1]:
+            ends = -2, -1
+        else:
+            return float(np.interp(reading, readings, degrees))
+        slope = (readings[ends[1]] - readings[ends[0]]) / (degrees[ends[1]] - degrees[ends[0]])
+        return degrees[ends[0]] + (reading - readings[ends[0]]) / slope
+
+    def reverse(self, value):
+        rtn = int(self.inverse(value))
+        logger.debug("{0} reverse {1} <- {2}".format(self.name, rtn, value))
+        return rtn
+
+    def to_dict(self):
+        model = self.model.to_dict()
+        if isinstance(self.model, PiecewiseLinearModel):
+            model['knots'] = [(knot * (self.high - self.low) + self.low + self.high) / 2
+                              for knot in self.model.knots]
+        return { 'name': self.name,
+                 'model': model,
+                 'low': self.low,
+                 'high': self.high,
+                 'forgetting': self.fit.forgetting,
+                 'theta': self.fit.theta.tolist(),
+                 'covariance': self.fit.covariance.tolist(),
+                 'count': self.fit.count,
+                 'until': self.until }
+
+    @classmethod
+    def from_dict(cls, d):
+        calibration = cls(d['name'], model_from_dict(d['model']), d['low'], d['high'],
+                          d['forgetting'])
+        calibration.fit.theta = np.array(d['theta'], dtype=float)
+        calibration.fit.covariance = np.array(d['covariance'], dtype=float)
+        calibration.fit.count = d['count']
+        calibration.until = d['until']
+        return calibration
+
+def save_calibrations(path, calibrations):
+    """Write {axis: Calibration} to path (replacing it in one step)."""
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as f:
+        json.dump({ 'version': VERSION,
+                    'axes': dict((axis, calibration.to_dict())
+                                 for axis, calibration in calibrations.items()) },
+                  f, indent=4, sort_keys=True)
+    os.rename(temporary, path)
+
+def load_calibrations(path):
+    """Read {axis: Calibration} from path."""
+    with open(path) as f:
+        saved = json.load(f)
+    if saved.get('version') != VERSION:
+        raise ValueError("{0} is not a version {1} calibration file".format(path, VERSION))
+    return dict((str(axis), Calibration.from_dict(d)) for axis, d in saved['axes'].items())
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+"""Check the vectorized solar position engine against astral over a
+full year.
+
+Astral 0.6.1 computes the Julian day from the *local* date, so for the
+hours when the local and UTC dates differ (evenings in US/Eastern) it
+is a day off. Its hour angle also wraps incorrectly around local
+midnight. Both are reported separately from the daylight comparison.
+"""
+
+from astral import City
+from solar_position import location_solar_position
+import datetime
+import numpy as np
+import pytz
+import time
+
+STEP_MINUTES = 10
+YEAR = 2012
+
+def check_solar_position():
+    upland = City(("Upland", "USA", "40°27'22\"N", "85°29'43\"W", "US/Eastern"))
+
+    start = datetime.datetime(YEAR, 1, 1, tzinfo=pytz.utc)
+    delta = datetime.timedelta(minutes=STEP_MINUTES)
+    times = [ ]
+    when = start
+    while when.year == YEAR:
+        times.append(when.astimezone(upland.tz))
+        when += delta
+
+    started = time.time()
+    azimuth, elevation = location_solar_position(upland, times)
+    numpy_seconds = time.time() - started
+
+    started = time.time()
+    astral_azimuth = np.array([upland.solar_azimuth(when) for when in times])
+    astral_elevation = np.array([upland.solar_elevation(when) for when in times])
+    astral_seconds = time.time() - started
+
+    az_error = np.abs((azimuth - astral_azimuth + 180.0) % 360.0 - 180.0)
+    el_error = np.abs(elevation - astral_elevation)
+    daylight = astral_elevation > 0
+    same_date = np.array([when.date() == when.astimezone(pytz.utc).date() for when in times])
+
+    print "{0} samples, every {1} minutes in {2}".format(len(times), STEP_MINUTES, YEAR)
+    print "NumPy {0:.3f}s, astral {1:.3f}s ({2:.0f}x)".format(numpy_seconds, astral_seconds,
+                                                            astral_seconds / numpy_seconds)
+    for label, mask in (('Daylight, same date', daylight & same_date),
+                        ('Daylight, all', daylight),
+                        ('All', np.ones(len(times), dtype=bool))):
+        print "{0:20s} max AZ error {1:.6f} max EL error {2:.6f}".format(label,
+                                                                         az_error[mask].max(),
+                                                                         el_error[mask].max())
+    print "Integer degrees differing in daylight: AZ {0} EL {1}".format(
+        np.sum(np.trunc(azimuth[daylight]) != np.trunc(astral_azimuth[daylight])),
+        np.sum(np.trunc(elevation[daylight]) != np.trunc(astral_elevation[daylight])))
+
+check_solar_position()
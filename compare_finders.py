@@ -49,11 +49,20 @@ def compare_finders():
     to_time = datetime.datetime(2012, 8, 21, 17, 0, tzinfo=upland.tz)
     sunrise = upland.sunrise(from_time)
     sunset = upland.sunset(from_time)
+
+    times = [ ]
     when = from_time
     while when <= to_time:
+        times.append(when)
+        when += delta
+
+    empirical_azs, empirical_els = empirical.find_many(times)
+    astral_azs, astral_els = astral.find_many(times)
+
+    for when, empirical_az, empirical_el, astral_az, astral_el in zip(times,
+                                                                     empirical_azs, empirical_els,
+                                                                     astral_azs, astral_els):
         day_night = 'DAY' if sunrise < when < sunset else 'NIGHT'
-        empirical_az, empirical_el = empirical.find(when)
-        astral_az, astral_el = astral.find(when)
         if MODE == 'Full':
             print "{0:%H:%M},'EMPIRICAL',{1},{2},'ASTRAL',{3},{4},'DELTA',{5},{6},'{7}'".format(
                 when,
@@ -68,8 +77,6 @@ def compare_finders():
         else:
             raise ValueException()
 
-        when += delta
-
     if MODE == 'Delta':
         average_value_by_key('AZ', az_correction)
         average_value_by_key('EL', el_correction)
@@ -0,0 +1,138 @@
+"""Compensation for the azimuth reading's drift with elevation.
+
+Sweep logs (see sweep_analysis) show the azimuth string-pot reading
+moving as the mirror is tipped, by an amount that depends on both
+elevation and azimuth. A CompensationTable holds that drift, smoothed,
+for every (elevation reading, azimuth reading), so CompassController
+can aim the azimuth at the reading it will actually settle on.
+
+Only how the drift varies with elevation matters: a constant offset at
+a given azimuth belongs to the calibration, so each azimuth column is
+taken relative to its own mean.
+
+Build a table from sweep logs and/or telemetry with
+
+    python compensation.py [LOG ...] [--telemetry telemetry.dat]
+"""
+
+from __future__ import division
+
+import argparse
+import os
+
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+COMPENSATION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'compensation.npy')
+
+SMOOTHING_RADIUS = 3            # Cells each way averaged into each cell
+MIN_SAMPLES = 5                 # Samples (after smoothing) needed to trust a cell
+SWEEP_GAP = 30.0                # Seconds without an elevation change that end a telemetry sweep
+MAX_DRIFT = 30                  # Larger azimuth change in a sweep means azimuth was moved too
+
+def _window_sums(values, radius):
+    """Sum of values over the (2 radius + 1)-cell square around each cell."""
+    width = 2 * radius + 1
+    for _ in range(2):
+        rows, columns = values.shape
+        padded = np.concatenate([np.zeros((radius + 1, columns)), values,
+                                 np.zeros((radius, columns))])
+        sums = np.cumsum(padded, axis=0)
+        values = (sums[width:] - sums[:-width]).T
+    return values
+
+def telemetry_offsets(records, shape=None):
+    """SweepOffsets from telemetry records (oldest first): while the
+    elevation reading keeps changing (at least every SWEEP_GAP seconds),
+    each azimuth reading is compared with the one from just before it
+    started, as in a sweep.
+    Sweeps in which the azimuth was plainly being moved too are left out.
+    """
+    from sweep_analysis import SweepOffsets     # It imports heliostat, which imports us
+
+    offsets = SweepOffsets() if shape is None else SweepOffsets(shape)
+    sweeps = [ ]                # (reference azimuth, [(elevation, drift), ...])
+    previous = None             # (azimuth, elevation) of the last record
+    changed = None              # Time the elevation last changed
+    for when, azimuth, elevation in zip(records['time'], records['azimuth'],
+                                        records['elevation']):
+        azimuth, elevation = int(azimuth), int(elevation)
+        if previous is not None and elevation != previous[1]:
+            if changed is None or when - changed >= SWEEP_GAP:
+                sweeps.append((previous[0], [ ]))
+            changed = when
+        if changed is not None and when - changed < SWEEP_GAP:
+            reference, samples = sweeps[-1]
+            samples.append((elevation, azimuth - reference))
+        previous = (azimuth, elevation)
+
+    for reference, samples in sweeps:
+        if max(abs(drift) for _, drift in samples) <= MAX_DRIFT:
+            offsets.add([el for el, _ in samples], [reference] * len(samples),
+                        [drift for _, drift in samples])
+    return offsets
+
+class CompensationTable(object):
+    """Drift of the azimuth reading, indexed [elevation reading,
+    azimuth reading].
+    """
+    def __init__(self, table):
+        self.table = table
+
+    @classmethod
+    def from_offsets(cls, offsets, radius=SMOOTHING_RADIUS, min_samples=MIN_SAMPLES):
+        """Smooth SweepOffsets into a table; cells without enough
+        samples nearby get no compensation.
+        """
+        count = _window_sums(offsets.count.astype(float), radius)
+        total = _window_sums(offsets.total, radius)
+        trusted = count >= min_samples
+        with np.errstate(divide='ignore', invalid='ignore'):
+            table = np.where(trusted, total / count, 0.0)
+            column_count = np.where(trusted, count, 0.0).sum(axis=0)
+            column_mean = np.where(column_count > 0,
+                                   (table * np.where(trusted, count, 0.0)).sum(axis=0) / column_count,
+                                   0.0)
+        table = np.where(trusted, table - column_mean, 0.0)
+        return cls(table.astype(np.float32))
+
+    @classmethod
+    def load(cls, path=COMPENSATION_FILE):
+        return cls(np.load(path))
+
+    def save(self, path=COMPENSATION_FILE):
+        np.save(path, self.table)
+
+    def drift(self, elevation, azimuth):
+        """Expected drift (whole reading units) of the azimuth reading
+        at these readings; 0 outside the table.
+        """
+        rows, columns = self.table.shape
+        if not (0 <= elevation < rows and 0 <= azimuth < columns):
+            return 0
+        return int(round(self.table[int(elevation), int(azimuth)]))
+
+if __name__ == '__main__':
+    from sweep_analysis import SweepOffsets, analyse_logs
+    from telemetry import TelemetryStore
+
+    parser = argparse.ArgumentParser(description='Build the azimuth drift compensation table')
+    parser.add_argument('logs', nargs='*', help='sweep logs (plain or .gz)')
+    parser.add_argument('--telemetry', help='telemetry store to use as well')
+    parser.add_argument('--output', default=COMPENSATION_FILE, help='table to write')
+    parser.add_argument('--radius', type=int, default=SMOOTHING_RADIUS, help='smoothing radius')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes')
+    args = parser.parse_args()
+
+    offsets = analyse_logs(args.logs, args.processes) if args.logs else SweepOffsets()
+    if args.telemetry:
+        records = TelemetryStore(args.telemetry, mode='r').read()
+        offsets.merge(telemetry_offsets(records, offsets.count.shape))
+
+    compensation = CompensationTable.from_offsets(offsets, args.radius)
+    compensation.save(args.output)
+    print "{0} samples ({1} outside the table); {2} cells compensated, largest {3:.1f}".format(
+        offsets.count.sum(), offsets.ignored, np.count_nonzero(compensation.table),
+        np.abs(compensation.table).max())
@@ -0,0 +1,153 @@
+"""Dense grid of corrections to the computed sun position.
+
+corrections.csv lists, for some computed solar azimuths and mirror
+elevations, the value actually observed. Those are compiled into two
+grids of offsets over (solar azimuth, solar elevation) at GRID_STEP
+degree spacing, which are interpolated bilinearly between the nodes
+that have corrections, and cached next to the source in NumPy's binary
+format so that later loads are nearly free. As before, a position is
+only corrected if the node it truncates to has a correction, so
+nothing outside the table is. The source is checked for changes at
+most every REFRESH_INTERVAL seconds, and reloaded if it has changed.
+
+Each line of the source is "which,computed,observed[,at]" where which
+is AZ or EL. An AZ line corrects the solar azimuth computed; an EL line
+corrects the mirror elevation computed. Without "at" a line applies
+whatever the other coordinate is; with it, only at that solar
+elevation (for AZ) or solar azimuth (for EL).
+"""
+
+from __future__ import division
+
+import os
+import time
+
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+CORRECTIONS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corrections.csv')
+
+GRID_STEP = 1                   # Degrees between grid nodes
+REFRESH_INTERVAL = 60           # Seconds between checks of the source for changes
+AZIMUTH_NODES = 360 // GRID_STEP + 1    # 0 to 360 degrees
+ELEVATION_NODES = 180 // GRID_STEP + 1  # -90 to 90 degrees
+AZ, EL = 0, 1                   # Grid layers of offsets...
+AZ_KNOWN, EL_KNOWN = 2, 3       # ...and of 1 where each has a correction
+
+def _azimuth_index(azimuth):
+    return int(round(azimuth / GRID_STEP))
+
+def _elevation_index(elevation):
+    return int(round((elevation + 90) / GRID_STEP))
+
+def compile_corrections(path):
+    """Read a corrections file and return the offset grids as an
+    array indexed [layer, elevation node, azimuth node].
+    """
+    grid = np.zeros((4, ELEVATION_NODES, AZIMUTH_NODES), dtype=np.float32)
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            fields = line.split(',')
+            which, computed, observed = fields[0], int(fields[1]), int(fields[2])
+            at = float(fields[3]) if len(fields) > 3 else None
+
+            if which == 'AZ':
+                rows = slice(None) if at is None else _elevation_index(at)
+                grid[AZ, rows, _azimuth_index(computed)] = observed - computed
+                grid[AZ_KNOWN, rows, _azimuth_index(computed)] = 1
+            elif which == 'EL':
+                # Mirror elevation m is 90 - (90 - s) / 2 for solar
+                # elevation s, so it truncates to m for s in [2m - 90, 2m - 88).
+                columns = slice(None) if at is None else _azimuth_index(at)
+                for solar_elevation in range(2 * computed - 90, 2 * computed - 88, GRID_STEP):
+                    if -90 <= solar_elevation <= 90:
+                        grid[EL, _elevation_index(solar_elevation), columns] = observed - computed
+                        grid[EL_KNOWN, _elevation_index(solar_elevation), columns] = 1
+            else:
+                raise ValueError("Invalid type of correction '{0}'".format(which))
+    return grid
+
+class CorrectionGrid(object):
+    def __init__(self, path=CORRECTIONS_FILE):
+        """Load the corrections in path, from the compiled cache next
+        to it if that is up to date.
+        """
+        self.path = path
+        self.cache_path = os.path.splitext(path)[0] + '.npy'
+        self.stamp = None
+        self.grid = None
+        self.checked = None     # When the source was last checked for changes
+        self.refresh(force=True)
+
+    def _load(self, stamp):
+        cache_stamp = os.stat(self.cache_path) if os.path.exists(self.cache_path) else None
+        if cache_stamp is not None and cache_stamp.st_mtime >= stamp[0]:
+            # A plain array over the mapping: indexing a memmap is slow.
+            self.grid = np.asarray(np.load(self.cache_path, mmap_mode='r'))
+        else:
+            logger.info("Compiling corrections from %s", self.path)
+            self.grid = compile_corrections(self.path)
+            try:
+                np.save(self.cache_path, self.grid)
+            except IOError as e:
+                logger.warning("Can't cache corrections in %s: %s", self.cache_path, e)
+        self.stamp = stamp
+
+    def refresh(self, force=False):
+        """Reload the corrections if the source has changed, checking
+        no more than every REFRESH_INTERVAL seconds unless forced.
+        Return True if they were (re)loaded.
+        """
+        now = time.time()
+        if not force and self.checked is not None and now - self.checked < REFRESH_INTERVAL:
+            return False
+        self.checked = now
+        st = os.stat(self.path)
+        stamp = (st.st_mtime, st.st_size)
+        if stamp == self.stamp:
+            return False
+        if self.stamp is not None:
+            logger.info("Corrections in %s changed; reloading", self.path)
+        self._load(stamp)
+        return True
+
+    def cache_key(self):
+        """Value that changes whenever the corrections do."""
+        self.refresh()
+        return (self.path, self.stamp)
+
+    def _interpolate(self, layer, known, azimuth, elevation):
+        """Offsets at (azimuth, elevation), weighting only the nodes
+        around each that have a correction; zero unless the node each
+        truncates to has one.
+        """
+        x = np.clip(np.asarray(azimuth, dtype=float) / GRID_STEP, 0, AZIMUTH_NODES - 1)
+        y = np.clip((np.asarray(elevation, dtype=float) + 90) / GRID_STEP, 0, ELEVATION_NODES - 1)
+        x0 = np.minimum(np.floor(x).astype(int), AZIMUTH_NODES - 2)
+        y0 = np.minimum(np.floor(y).astype(int), ELEVATION_NODES - 2)
+        fx, fy = x - x0, y - y0
+
+        offsets, weights = self.grid[layer], self.grid[known]
+        total = np.zeros(x.shape)
+        weight = np.zeros(x.shape)
+        for dy, wy in ((0, 1 - fy), (1, fy)):
+            for dx, wx in ((0, 1 - fx), (1, fx)):
+                w = wx * wy * weights[y0 + dy, x0 + dx]
+                total += w * offsets[y0 + dy, x0 + dx]
+                weight += w
+        inside = (weights[y0, x0] > 0) & (weight > 0)
+        return np.where(inside, total / np.maximum(weight, 1e-9), 0.0)
+
+    def correct(self, solar_azimuth, solar_elevation, mirror_elevation):
+        """Return the corrected solar azimuth and mirror elevation for
+        arrays of computed solar azimuth, solar elevation and mirror
+        elevation.
+        """
+        self.refresh()
+        return (solar_azimuth + self._interpolate(AZ, AZ_KNOWN, solar_azimuth, solar_elevation),
+                mirror_elevation + self._interpolate(EL, EL_KNOWN, solar_azimuth, solar_elevation))
@@ -0,0 +1,383 @@
+"""Daemon that owns the heliostat's serial port.
+
+One long-running process opens the port and the CompassController (so
+the startup stop() is paid once) and runs commands from any number of
+clients one at a time: a stop first, then manual moves, then tracking,
+and oldest first within each. A stop also cancels everything queued
+behind it.
+
+Only the latest target for an axis matters. A new move replaces any
+queued move of the same axes (and no higher priority), and if the move
+running now is one of those it is abandoned at once, waking it from
+any sleep between checks, so the mirror heads straight for the newest
+target. A replaced command is
+answered with the result of the one that replaced it.
+
+Clients talk to it over a Unix socket, one JSON object per line each
+way. DaemonClient wraps that in the controller interface track() and
+the scripts use, so none of them opens the port itself:
+
+    {"op": "azimuth", "args": [180, null], "priority": 1, "wait": false}
+    {"ok": true, "id": 7, "position": [176, 58]}
+
+A command is answered as soon as it is queued, with the last known
+position, unless it asks to wait, when it is answered with its result.
+The same requests can be made over HTTP (see status_api).
+"""
+
+import argparse
+import heapq
+import inspect
+import itertools
+import json
+import os
+import socket
+import SocketServer
+import threading
+
+from calibration import CALIBRATION_FILE
+from heliostat import CompassController, StringPotProtocol, Superseded, clamp
+from status_api import make_status_server, HTTP_PORT
+from telemetry import TelemetryStore, TELEMETRY_FILE
+
+import logging
+logger = logging.getLogger(__name__)
+
+SOCKET_PATH = '/tmp/heliostat.sock'
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+
+PRIORITY_STOP = 0               # Lower numbers run first
+PRIORITY_MANUAL = 1
+PRIORITY_TRACKING = 2
+
+METRICS_INTERVAL = 15           # Seconds between writes of the metrics file
+
+COMMANDS = ('stop', 'azimuth', 'elevation', 'move_to')     # Queued; run on the port
+AXES = { 'stop': ('azimuth', 'elevation'),                  # Axes each command sets
+         'azimuth': ('azimuth',),
+         'elevation': ('elevation',),
+         'move_to': ('azimuth', 'elevation') }
+QUERIES = ('position', 'move_time', 'report_stats',         # Answered at once
+           'azimuth_elevation_limits')
+
+class DaemonError(Exception):
+    pass
+
+class Command(object):
+    def __init__(self, op, args, priority, raw=False, note=None):
+        """A call of controller.op(*args). Raw commands work in
+        string-pot readings (StringPotProtocol's operations); note is
+        logged when the command starts.
+        """
+        self.op = op
+        self.args = args
+        self.priority = priority
+        self.raw = raw
+        self.note = note
+        self.id = None
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+        self.obsolete = False   # Replaced while running
+        self.replaced = [ ]     # Commands this one replaced, finished along with it
+
+    def supersedes(self, other):
+        """Does this command make other pointless?"""
+        return (set(AXES[other.op]) <= set(AXES[self.op]) and self.priority <= other.priority)
+
+    def finish(self, result=None, error=None):
+        if self.done.is_set():
+            return              # Finished before the command replacing it did
+        self.result = result
+        self.error = error
+        self.done.set()
+        for command in self.replaced:
+            command.finish(result, error)
+
+class CommandQueue(object):
+    """Commands waiting to run, by priority and then age, and the one
+    running now.
+    """
+    def __init__(self):
+        self._heap = [ ]
+        self._ids = itertools.count(1)
+        self._ready = threading.Condition()
+        self.current = None     # Command running now
+        self.aborting = threading.Event()   # Set when the running command is replaced
+        self.coalesced = 0      # Queued commands replaced by newer ones
+        self.aborted = 0        # Running commands abandoned for newer ones
+
+    def __len__(self):
+        with self._ready:
+            return len(self._heap)
+
+    def put(self, command):
+        with self._ready:
+            command.id = next(self._ids)
+            if command.op == 'stop':
+                for _, _, pending in self._heap:
+                    pending.finish(error='Cancelled by stop')
+                del self._heap[:]
+            else:
+                kept = [ ]
+                for entry in self._heap:
+                    if command.supersedes(entry[2]):
+                        logger.debug("Command %d replaces %d", command.id, entry[2].id)
+                        command.replaced.append(entry[2])
+                        self.coalesced += 1
+                    else:
+                        kept.append(entry)
+                self._heap = kept
+                heapq.heapify(self._heap)
+
+            current = self.current
+            if current is not None and not current.obsolete and command.supersedes(current):
+                logger.debug("Command %d replaces running %d", command.id, current.id)
+                current.obsolete = True
+                self.aborting.set()
+                command.replaced.append(current)
+                self.aborted += 1
+
+            heapq.heappush(self._heap, (command.priority, command.id, command))
+            self._ready.notify()
+        return command.id
+
+    def get(self):
+        """Wait for the next command and make it the current one."""
+        with self._ready:
+            while not self._heap:
+                self._ready.wait()
+            self.current = heapq.heappop(self._heap)[2]
+            self.aborting.clear()
+            return self.current
+
+    def task_done(self):
+        with self._ready:
+            self.current = None
+
+class HeliostatDaemon(object):
+    def __init__(self, controller, path=SOCKET_PATH):
+        self.controller = controller
+        self.queue = CommandQueue()
+        self.path = path
+        controller.superseded = self._superseded
+        controller.abort = self.queue.aborting
+
+        if os.path.exists(path):
+            os.unlink(path)     # Left over from a daemon that didn't shut down
+        self.server = _Server(path, _Handler)
+        self.server.heliostat = self
+
+        self._worker = threading.Thread(target=self._run, name='commands')
+        self._worker.daemon = True
+        self._worker.start()
+
+    def serve_forever(self):
+        logger.info("Listening on %s", self.path)
+        self.server.serve_forever()
+
+    def close(self):
+        """Stop the mirror and stop serving."""
+        self.submit(Command('stop', [ ], PRIORITY_STOP)).done.wait()
+        self.server.shutdown()
+        self.server.server_close()
+        os.unlink(self.path)
+
+    def _superseded(self, which_metric):
+        current = self.queue.current
+        return current is not None and current.obsolete
+
+    def submit(self, command):
+        self.queue.put(command)
+        return command
+
+    def _run(self):
+        while True:
+            command = self.queue.get()
+            if command.note:
+                logger.info("*** %s", command.note)
+            try:
+                if command.raw:
+                    result = self.controller.run(self.controller.raw(command.op, *command.args))
+                    self.controller.readings = result
+                else:
+                    result = getattr(self.controller, command.op)(*command.args)
+            except Superseded:
+                logger.info("Command %d (%s) superseded", command.id, command.op)
+            except Exception as e:
+                logger.exception("Command %d (%s) failed", command.id, command.op)
+                command.finish(error=str(e))
+            else:
+                command.finish(result)
+            finally:
+                self.queue.task_done()
+
+    def handle(self, request):
+        """Act on a request from a client; return the reply."""
+        if not isinstance(request, dict):
+            return { 'ok': False, 'error': "Bad request: not a JSON object" }
+        op = request.get('op')
+        args = request.get('args', [ ])
+        raw = bool(request.get('raw', False))
+        if op not in QUERIES and op not in COMMANDS:
+            return { 'ok': False, 'error': "Unknown operation '{0}'".format(op) }
+        if raw and op in COMMANDS:
+            method = getattr(StringPotProtocol, '_' + op)
+        else:
+            method = getattr(type(self.controller), op)
+        error = _check_args(op, method, args)
+        if error is not None:
+            return { 'ok': False, 'error': "Bad request: {0}".format(error) }
+
+        if op in QUERIES:
+            try:
+                return { 'ok': True, 'result': getattr(self.controller, op)(*args) }
+            except (TypeError, ValueError) as e:
+                return { 'ok': False, 'error': str(e) }
+
+        priority = request.get('priority', PRIORITY_STOP if op == 'stop' else PRIORITY_MANUAL)
+        if not isinstance(priority, int):
+            return { 'ok': False, 'error': "Bad request: priority must be an integer" }
+        command = self.submit(Command(op, args, priority, raw, request.get('note')))
+        if not request.get('wait'):
+            return { 'ok': True, 'id': command.id, 'position': self.controller.position() }
+
+        command.done.wait()
+        if command.error is not None:
+            return { 'ok': False, 'id': command.id, 'error': command.error }
+        return { 'ok': True, 'id': command.id, 'result': command.result,
+                 'position': self.controller.position() }
+
+def _check_args(op, method, args):
+    """Why args can't be passed to method (the controller method, not
+    bound, for op), or None if they can.
+    """
+    if not isinstance(args, list):
+        return "args must be a list"
+    spec = inspect.getargspec(method)
+    most = len(spec.args) - 1
+    least = most - len(spec.defaults or ())
+    if not least <= len(args) <= most:
+        expected = str(most) if least == most else "{0}-{1}".format(least, most)
+        return "{0} takes {1} arguments, not {2}".format(op, expected, len(args))
+    return None
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+class _Handler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            try:
+                reply = self.server.heliostat.handle(json.loads(line))
+            except ValueError as e:
+                reply = { 'ok': False, 'error': "Bad request: {0}".format(e) }
+            except Exception as e:
+                logger.exception("Request %r failed", line)
+                reply = { 'ok': False, 'error': str(e) }
+            self.wfile.write(json.dumps(reply) + '\n')
+            self.wfile.flush()
+
+class DaemonClient(object):
+    """The controller interface that track() and the scripts use,
+    passed on to the daemon. Moves return as soon as the daemon has
+    queued them, with the last position it knows, unless wait is set;
+    stop() always waits for the mirror to stop.
+    """
+    def __init__(self, path=SOCKET_PATH, priority=PRIORITY_MANUAL, wait=False):
+        self.priority = priority
+        self.wait = wait
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(path)
+        self.rfile = self.socket.makefile('rb')
+        self.wfile = self.socket.makefile('wb')
+
+    def close(self):
+        self.rfile.close()
+        self.wfile.close()
+        self.socket.close()
+
+    def call(self, op, *args, **options):
+        """Send a request for op(*args) and return the reply."""
+        request = dict(options, op=op, args=list(args))
+        self.wfile.write(json.dumps(request) + '\n')
+        self.wfile.flush()
+        line = self.rfile.readline()
+        if not line:
+            raise DaemonError("Daemon closed the connection")
+        reply = json.loads(line)
+        if not reply['ok']:
+            raise DaemonError(reply['error'])
+        return reply
+
+    def _command(self, op, *args, **options):
+        options.setdefault('priority', self.priority)
+        options.setdefault('wait', self.wait)
+        reply = self.call(op, *args, **options)
+        return tuple(reply['result'] if 'result' in reply else reply['position'])
+
+    def stop(self):
+        return tuple(self.call('stop', wait=True)['result'])
+
+    def azimuth(self, compass_azimuth, speed=None, **options):
+        return self._command('azimuth', compass_azimuth, speed, **options)
+
+    def elevation(self, mirror_elevation, speed=None, **options):
+        return self._command('elevation', mirror_elevation, speed, **options)
+
+    def move_to(self, compass_azimuth, mirror_elevation, speed=None, **options):
+        return self._command('move_to', compass_azimuth, mirror_elevation, speed, **options)
+
+    def position(self):
+        return tuple(self.call('position')['result'])
+
+    def move_time(self, compass_azimuth, mirror_elevation):
+        return self.call('move_time', compass_azimuth, mirror_elevation)['result']
+
+    def report_stats(self):
+        self.call('report_stats')
+
+    def azimuth_elevation_limits(self):
+        return tuple(tuple(limits) for limits in self.call('azimuth_elevation_limits')['result'])
+
+    def clamp_azimuth_elevation(self, azimuth, elevation):
+        (az_min, az_max), (el_min, el_max) = self.azimuth_elevation_limits()
+        return (clamp(azimuth, az_min, az_max), clamp(elevation, el_min, el_max))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Own the heliostat port and serve its commands')
+    parser.add_argument('--device', default='/dev/ttyUSB0', help='serial device')
+    parser.add_argument('--socket', default=SOCKET_PATH, help='Unix socket to listen on')
+    parser.add_argument('--telemetry', default=TELEMETRY_FILE, help='telemetry store')
+    parser.add_argument('--calibration', nargs='?', const=CALIBRATION_FILE, default=None,
+                        help='use the fitted calibration in this file (see calibrate.py)')
+    parser.add_argument('--http', type=int, default=HTTP_PORT,
+                        help='port for the HTTP status API (0 for none)')
+    parser.add_argument('--metrics', help='file to keep the metrics in (Prometheus text format)')
+    parser.add_argument('--log-level', default='INFO', choices=LOG_LEVELS,
+                        help='DEBUG logs every response, as sweep_analysis needs')
+    args = parser.parse_args()
+    logging.getLogger().setLevel(getattr(logging, args.log_level))
+
+    controller = CompassController(args.device, telemetry=TelemetryStore(args.telemetry),
+                                   calibration=args.calibration)
+    daemon = HeliostatDaemon(controller, args.socket)
+    http = make_status_server(daemon, port=args.http) if args.http else None
+    threads = [threading.Thread(target=daemon.serve_forever, name='socket')]
+    if http is not None:
+        threads.append(threading.Thread(target=http.serve_forever, name='http'))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        while threads[0].is_alive():
+            threads[0].join(METRICS_INTERVAL if args.metrics else 1)
+            if args.metrics:
+                controller.metrics.write(args.metrics)
+    except KeyboardInterrupt:
+        logger.warning("Caught keyboard interrupt; stopping.")
+    finally:
+        if http is not None:
+            http.shutdown()
+        daemon.close()
+        controller.report_stats()
@@ -0,0 +1,167 @@
+"""Precomputed daily ephemeris for the tracker.
+
+Rather than asking a finder for the sun's position on every pass
+through the tracking loop, build a dense table of clamped positions for
+the whole (local) day up front and index into it by time of day.
+"""
+
+from __future__ import division
+
+import datetime
+import hashlib
+import os
+
+import numpy as np
+
+from solar_finders import (mirror_elevation, solar_elevation, seconds_since_midnight,
+                           MIRROR)
+
+import logging
+logger = logging.getLogger(__name__)
+
+RESOLUTION = 1                  # Seconds between table entries
+SECONDS_PER_DAY = 86400
+SOLAR_ELEVATION_MIN = 20        # Below this, hold the mirror where this sun would put it
+
+def mirror_elevation_range(limits):
+    """The (lowest, highest) mirror elevation to track with, given
+    limits ((az_min, az_max), (el_min, el_max)) in mirror degrees.
+    """
+    _, (el_min, el_max) = limits
+    return max(el_min, int(np.ceil(mirror_elevation(SOLAR_ELEVATION_MIN)))), el_max
+
+def clamped_targets(azimuth, elevation, limits, elevation_kind):
+    """Arrays of compass azimuth, solar elevation and mirror elevation
+    from a finder's azimuths and (elevation_kind) elevations, clamped
+    to limits ((az_min, az_max), (el_min, el_max)): the azimuth to the
+    first, the mirror elevation to the second (see
+    mirror_elevation_range), and the solar elevation to match.
+    """
+    (az_min, az_max), _ = limits
+    low, high = mirror_elevation_range(limits)
+    if elevation_kind == MIRROR:
+        mirror = np.clip(elevation, low, high)
+        solar = solar_elevation(mirror)
+    else:
+        mirror = np.clip(np.ceil(mirror_elevation(np.asarray(elevation))), low, high)
+        solar = np.clip(elevation, solar_elevation(low), solar_elevation(high))
+    return np.clip(azimuth, az_min, az_max), solar, mirror
+
+class DailyEphemeris(object):
+    """Table of clamped compass azimuth, solar elevation and mirror
+    elevation for one local day, one row per RESOLUTION seconds.
+
+    The table is rebuilt when the local date rolls over, and by
+    refresh() when the finder's location or corrections, or the
+    limits, have changed since it was built.
+    If cache_dir is given, tables are saved there and memory-mapped
+    back in, so a restart on the same day doesn't recompute them.
+    """
+    def __init__(self, finder, limits, tz=None, resolution=RESOLUTION, cache_dir=None):
+        if SECONDS_PER_DAY % resolution != 0:
+            raise ValueError("Resolution {0} does not divide a day".format(resolution))
+        self.finder = finder
+        self.limits = limits    # Callable returning ((az_min, az_max), (el_min, el_max))
+        self.tz = tz if tz is not None else finder.location.tz
+        self.resolution = resolution
+        self.cache_dir = cache_dir
+
+        self.date = None
+        self.key = None
+        self.table = None
+        self.changes = None     # Indices where azimuth or mirror elevation changes
+
+    def _current_key(self):
+        return (self.finder.cache_key(), self.limits(), self.resolution)
+
+    def _cache_path(self, date, key):
+        digest = hashlib.md5(repr(key).encode('utf-8')).hexdigest()[:12]
+        return os.path.join(self.cache_dir, "ephemeris-{0:%Y%m%d}-{1}.npy".format(date, digest))
+
+    def _compute(self, date):
+        midnight = datetime.datetime.combine(date, datetime.time())
+        step = datetime.timedelta(seconds=self.resolution)
+        times = [midnight + step * idx for idx in range(SECONDS_PER_DAY // self.resolution)]
+
+        azimuth, elevation = self.finder.find_many(times)
+        targets = clamped_targets(azimuth, elevation, self.limits(), self.finder.elevation_kind)
+        return np.vstack(targets).astype(np.int16)
+
+    def build(self, date):
+        """(Re)build the table for the given local date."""
+        key = self._current_key()
+        path = self._cache_path(date, key) if self.cache_dir is not None else None
+
+        if path is not None and os.path.exists(path):
+            logger.info("Loading ephemeris for %s from %s", date, path)
+            table = np.load(path, mmap_mode='r')
+        else:
+            logger.info("Computing ephemeris for %s at %ds resolution", date, self.resolution)
+            table = self._compute(date)
+            if path is not None:
+                np.save(path, table)
+                table = np.load(path, mmap_mode='r')
+
+        moves = np.any(np.diff(table[[0, 2]], axis=1) != 0, axis=0)
+        self.date, self.key, self.table = date, key, table
+        self.changes = np.nonzero(moves)[0] + 1
+
+    def refresh(self):
+        """Rebuild the table if what it was built from has changed."""
+        if self.date is not None and self._current_key() != self.key:
+            logger.info("Finder or limits changed; rebuilding the ephemeris")
+            self.build(self.date)
+
+    def _local(self, when):
+        """Local time for when (default now), rebuilding the table if needed."""
+        if when is None:
+            when = datetime.datetime.now(self.tz)
+        elif when.tzinfo is not None:
+            when = when.astimezone(self.tz)
+
+        if when.date() != self.date:
+            self.build(when.date())
+        return when
+
+    def target(self, when=None):
+        """Return (azimuth, solar elevation, mirror elevation) at the
+        given time (default now).
+        """
+        when = self._local(when)
+        idx = int(seconds_since_midnight(when)) // self.resolution
+        azimuth, solar_elevation, mirror_elevation = self.table[:, idx]
+        return int(azimuth), int(solar_elevation), int(mirror_elevation)
+
+    def upcoming(self, when, seconds):
+        """Table columns (azimuth, solar elevation, mirror elevation)
+        from the given time to seconds later, or to the end of its day.
+        """
+        when = self._local(when)
+        idx = int(seconds_since_midnight(when)) // self.resolution
+        return self.table[:, idx:idx + int(seconds) // self.resolution + 1]
+
+    def _hold(self, when):
+        """Seconds since midnight at the given time, and the table
+        indices where the target holding then starts and ends.
+        """
+        when = self._local(when)
+        seconds = seconds_since_midnight(when)
+        pos = np.searchsorted(self.changes, int(seconds) // self.resolution, side='right')
+        start = self.changes[pos - 1] if pos > 0 else 0
+        end = self.changes[pos] if pos < len(self.changes) else self.table.shape[1]
+        return seconds, start, end
+
+    def next_change(self, when=None):
+        """Seconds from the given time (default now) until the azimuth
+        or mirror elevation next changes, or until the end of the day
+        if neither does.
+        """
+        seconds, _, end = self._hold(when)
+        return max(0.0, end * self.resolution - seconds)
+
+    def hold(self, when=None):
+        """Seconds for which the target at the given time (default now)
+        holds still, from one change to the next.
+        """
+        _, start, end = self._hold(when)
+        return (end - start) * self.resolution
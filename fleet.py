@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+
+"""Track the sun with several heliostats from one process.
+
+Each mirror has its own daemon (see daemon.py), which owns its port and
+its calibration; the fleet talks to every daemon through a
+DaemonClient. For a mirror given a device, the fleet starts that
+daemon itself (and starts it again if it dies), so one supervisord
+program runs the whole fleet; a mirror given only a socket is served
+by a daemon started some other way.
+
+A Fleet looks like one controller to track_sun's track(), so the sun
+is followed with the same loop, clock, lead and tracking policy as a
+single mirror: each move is queued with every mirror's daemon (which
+answers at once), so the mirrors move together. The fleet keeps what
+it last sent each mirror, and whenever it is told to move an axis it
+sends each mirror whatever that mirror needs to reach the whole
+target, so a mirror that started elsewhere, or has just come back, is
+set right on both axes.
+
+A mirror whose daemon can't be reached, or fails a request, is logged
+and left out; the fleet carries on with the rest, and tries it again at
+the next command.
+"""
+
+import argparse
+import collections
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from astral import City
+
+from daemon import DaemonClient, DaemonError, PRIORITY_TRACKING
+from heliostat import clamp
+from solar_finders import AstralSolarFinder
+from track_sun import track, TrackingPolicy, LEAD_FRACTION
+
+import logging
+logger = logging.getLogger(__name__)
+
+DAEMON = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'daemon.py')
+SOCKET_TEMPLATE = '/tmp/heliostat-{0}.sock'     # Default socket for each mirror's daemon
+TELEMETRY_TEMPLATE = 'telemetry-{0}.dat'        # Default telemetry store for each mirror
+DAEMON_START_TIMEOUT = 60       # Seconds to wait for a started daemon to listen
+DAEMON_START_POLL = 0.5         # Seconds between looks for its socket
+
+def load_fleet(path):
+    """Read a fleet description: a JSON list of mirrors, each with a
+    'name' and either a 'device' for the fleet to start a daemon on,
+    optionally with that mirror's 'calibration' file, 'telemetry'
+    store and 'http' port, or the 'socket' of a daemon already
+    running. Return an OrderedDict of name to settings, with the
+    defaults filled in.
+    """
+    with open(path) as f:
+        mirrors = json.load(f)
+
+    fleet = collections.OrderedDict()
+    for mirror in mirrors:
+        name = mirror['name']
+        fleet[name] = dict(socket=mirror.get('socket', SOCKET_TEMPLATE.format(name)),
+                           device=mirror.get('device'),
+                           calibration=mirror.get('calibration'),
+                           telemetry=mirror.get('telemetry', TELEMETRY_TEMPLATE.format(name)),
+                           http=mirror.get('http', 0))
+    return fleet
+
+class Fleet(object):
+    def __init__(self, fleet):
+        """Start the daemons of the mirrors in fleet (as returned by
+        load_fleet) that have a device, and connect to every mirror's
+        daemon; those that can't be reached are tried again later.
+        """
+        self.mirrors = fleet
+        self.daemons = { }      # Name -> daemon process we started
+        self.clients = collections.OrderedDict((name, None) for name in fleet)
+        self.sent = { }         # Name -> (azimuth, elevation) last sent, None if not known
+        self.target = (None, None)
+        for name in self.clients:
+            if fleet[name]['device'] is not None:
+                self._start(name)
+        for name in self.clients:
+            self._client(name)
+        if not any(self.clients.values()):
+            raise DaemonError("No mirror's daemon could be reached")
+
+    def _start(self, name):
+        """Start the named mirror's daemon."""
+        mirror = self.mirrors[name]
+        if os.path.exists(mirror['socket']):
+            os.unlink(mirror['socket'])     # So we can tell when the new daemon listens
+        command = [sys.executable, DAEMON, '--device', mirror['device'],
+                   '--socket', mirror['socket'], '--telemetry', mirror['telemetry'],
+                   '--http', str(mirror['http'])]
+        if mirror['calibration'] is not None:
+            command += ['--calibration', mirror['calibration']]
+        logger.info("Mirror %s: starting its daemon on %s", name, mirror['device'])
+        self.daemons[name] = subprocess.Popen(command)
+
+    def _wait_for_daemon(self, name):
+        """Wait for the named mirror's daemon, if we started it, to
+        listen; start it again first if it has died.
+        """
+        daemon = self.daemons.get(name)
+        if daemon is None:
+            return
+        if daemon.poll() is not None:
+            logger.error("Mirror %s: daemon exited with %d", name, daemon.returncode)
+            self._start(name)
+            daemon = self.daemons[name]
+        deadline = time.time() + DAEMON_START_TIMEOUT
+        while (not os.path.exists(self.mirrors[name]['socket']) and daemon.poll() is None
+               and time.time() < deadline):
+            time.sleep(DAEMON_START_POLL)
+
+    def _client(self, name):
+        """The client for the named mirror, connecting if need be; None
+        if its daemon can't be reached.
+        """
+        if self.clients[name] is None:
+            self._wait_for_daemon(name)
+            path = self.mirrors[name]['socket']
+            try:
+                self.clients[name] = DaemonClient(path, priority=PRIORITY_TRACKING)
+            except socket.error as e:
+                logger.error("Mirror %s: can't reach its daemon at %s: %s", name, path, e)
+        return self.clients[name]
+
+    @staticmethod
+    def _disconnect(client):
+        try:
+            client.close()
+        except socket.error:
+            pass                # Flushing to a daemon that has gone away
+
+    def _call(self, name, method, *args):
+        """Call method(*args) on the named mirror's client; return
+        (True, result), or (False, None) if it can't be reached or
+        fails, when it is logged and disconnected.
+        """
+        client = self._client(name)
+        if client is None:
+            return False, None
+        try:
+            return True, getattr(client, method)(*args)
+        except (DaemonError, socket.error, ValueError) as e:
+            logger.error("Mirror %s: %s failed: %s", name, method, e)
+            self._disconnect(client)
+            self.clients[name] = None
+            self.sent[name] = None
+            return False, None
+
+    def _each(self, method, *args):
+        """Call method(*args) on every mirror's client and return
+        {name: result}, leaving out the mirrors that fail.
+        """
+        results = collections.OrderedDict()
+        for name in self.clients:
+            ok, result = self._call(name, method, *args)
+            if ok:
+                results[name] = result
+        return results
+
+    def _steer(self, speed):
+        """Send each mirror what it needs to reach self.target: each
+        axis of the target it wasn't last sent, both at once if need
+        be. Return the first mirror's result, or the target if every
+        mirror was already on its way.
+        """
+        azimuth, elevation = self.target
+        results = [ ]
+        reached = False
+        for name in self.clients:
+            sent_azimuth, sent_elevation = self.sent.get(name) or (None, None)
+            move_azimuth = azimuth is not None and azimuth != sent_azimuth
+            move_elevation = elevation is not None and elevation != sent_elevation
+            if move_azimuth and move_elevation:
+                ok, result = self._call(name, 'move_to', azimuth, elevation, speed)
+            elif move_azimuth:
+                ok, result = self._call(name, 'azimuth', azimuth, speed)
+            elif move_elevation:
+                ok, result = self._call(name, 'elevation', elevation, speed)
+            else:
+                reached = reached or self.clients[name] is not None
+                continue
+            if ok:
+                self.sent[name] = (azimuth if azimuth is not None else sent_azimuth,
+                                   elevation if elevation is not None else sent_elevation)
+                results.append(result)
+        if not results and not reached:
+            raise DaemonError("No mirror took the command")
+        return results[0] if results else self.target
+
+    def stop(self):
+        positions = self._each('stop')
+        if not positions:
+            raise DaemonError("No mirror took the command")
+        self.sent = dict((name, tuple(position)) for name, position in positions.items())
+        self.target = positions.values()[0]
+        return self.target
+
+    def azimuth(self, compass_azimuth, speed=None):
+        self.target = (compass_azimuth, self.target[1])
+        return self._steer(speed)
+
+    def elevation(self, mirror_elevation, speed=None):
+        self.target = (self.target[0], mirror_elevation)
+        return self._steer(speed)
+
+    def move_to(self, compass_azimuth, mirror_elevation, speed=None):
+        self.target = (compass_azimuth, mirror_elevation)
+        return self._steer(speed)
+
+    def move_time(self, compass_azimuth, mirror_elevation):
+        """The longest any mirror predicts the move will take."""
+        return max(self._each('move_time', compass_azimuth, mirror_elevation).values() or [0.0])
+
+    def azimuth_elevation_limits(self):
+        """The limits every mirror can reach."""
+        limits = self._each('azimuth_elevation_limits').values()
+        if not limits:
+            raise DaemonError("No mirror's limits are known")
+        return ((max(az[0] for az, _ in limits), min(az[1] for az, _ in limits)),
+                (max(el[0] for _, el in limits), min(el[1] for _, el in limits)))
+
+    def clamp_azimuth_elevation(self, azimuth, elevation):
+        (az_min, az_max), (el_min, el_max) = self.azimuth_elevation_limits()
+        return (clamp(azimuth, az_min, az_max), clamp(elevation, el_min, el_max))
+
+    def report_stats(self):
+        self._each('report_stats')
+
+    def close(self):
+        """Disconnect from every daemon, and stop those we started."""
+        for client in self.clients.values():
+            if client is not None:
+                self._disconnect(client)
+        for name, daemon in self.daemons.items():
+            if daemon.poll() is None:
+                logger.info("Mirror %s: stopping its daemon", name)
+                daemon.terminate()
+                daemon.wait()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Track the sun with a fleet of heliostats')
+    parser.add_argument('config', help='JSON file describing the mirrors')
+    parser.add_argument('--lead', type=float, nargs='?', const=LEAD_FRACTION, default=None,
+                        help='lead the sun by this fraction of the hold interval')
+    parser.add_argument('--budget', type=float, default=None,
+                        help='pointing error budget (degrees) for the tracking policy')
+    args = parser.parse_args()
+
+    fleet = Fleet(load_fleet(args.config))
+    upland = City(("Upland", "USA", "40°27'22\"N", "85°29'43\"W", "US/Eastern"))
+
+    try:
+        track(fleet, AstralSolarFinder(upland), lead=args.lead,
+              policy=TrackingPolicy(budget=args.budget))
+    except KeyboardInterrupt:
+        logger.warning("Caught keyboard interrupt; sending stop comand.")
+        fleet.stop()
+    finally:
+        fleet.report_stats()
+        fleet.close()
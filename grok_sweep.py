@@ -1,66 +1,54 @@
 from heliostat import AZIMUTH_MIN, AZIMUTH_MAX, ELEVATION_MIN, ELEVATION_MAX
-import fileinput
-import re
+from sweep_analysis import analyse_logs
+import argparse
+import numpy as np
 
-requested_az = None
-requested_el = None
+parser = argparse.ArgumentParser(description='Tabulate azimuth offsets from sweep logs')
 
-adjusting_el = False
+parser.add_argument('logs', nargs='+', help='sweep logs (plain or .gz)')
+parser.add_argument('--stat', choices=('mean', 'std', 'count'), default='mean',
+                    help='statistic to tabulate')
+parser.add_argument('--processes', type=int, default=None, help='worker processes')
 
-az_offset = [ [ None for i in range(AZIMUTH_MAX + 1)] for j in range(ELEVATION_MAX + 1) ]
+args = parser.parse_args()
 
-print len(az_offset)
-print len(az_offset[0])
+DEGREE_STEP = 3
 
-for line in fileinput.input():
-    line = line.strip()
+offsets = analyse_logs(args.logs, args.processes)
+table = { 'mean': offsets.mean, 'std': offsets.std, 'count': lambda: offsets.count }[args.stat]()
 
-    m = re.search(r'MOVING AZIMUTH TO (?P<az>\d+)', line)
-    if m:
-        requested_az = int(m.group('az'))
-        adjusting_el = False
-        print 'REQ AZ', requested_az
-        
-    m = re.search(r'MOVING ELEVATION TO (?P<el>\d+)', line)
-    if m:
-        requested_el = int(m.group('el'))
-        adjusting_el = True
-        print 'REQ EL', requested_el
+print '{0} samples in {1} files, {2} outside the table'.format(offsets.count.sum(),
+                                                              len(args.logs), offsets.ignored)
 
-    if adjusting_el:
-        m = re.search(r'DEBUG.*91\) AZ (?P<az>\d+) EL (?P<el>\d+)', line)
-        if m:
-            actual_az = int(m.group('az'))
-            actual_el = int(m.group('el'))
-            print 'ACT AZ', actual_az, 'ACT EL', actual_el
-            az_offset[actual_el][requested_az] = actual_az - requested_az
+def cell(el, az):
+    value = table[el][az]
+    return value if offsets.count[el][az] > 0 and not np.isnan(value) else None
 
 #### Text
 print '  ',
 moving_up = True
-for j in xrange(AZIMUTH_MIN, AZIMUTH_MAX, 3):
+for j in xrange(AZIMUTH_MIN, AZIMUTH_MAX, DEGREE_STEP):
     print ' UP' if moving_up else ' DN',
     moving_up = not moving_up
 print
 
 print '  ',
-for az in xrange(AZIMUTH_MIN, AZIMUTH_MAX, 3):
+for az in xrange(AZIMUTH_MIN, AZIMUTH_MAX, DEGREE_STEP):
     print '{:3d}'.format(az),
 print
 
 for el in xrange(ELEVATION_MIN, ELEVATION_MAX + 1):
     print el,
-    for az in xrange(AZIMUTH_MIN, AZIMUTH_MAX + 1, 3):
-        offset = az_offset[el][az]
-        if offset is not None:
-            print '{:3d}'.format(offset),
+    for az in xrange(AZIMUTH_MIN, AZIMUTH_MAX + 1, DEGREE_STEP):
+        value = cell(el, az)
+        if value is not None:
+            print '{:3.0f}'.format(value),
         else:
             print '   ',
     print
 
 #### CSV
-print ',', ','.join([str(v) for v in xrange(AZIMUTH_MIN, AZIMUTH_MAX, 3)])
+print ',', ','.join([str(v) for v in xrange(AZIMUTH_MIN, AZIMUTH_MAX, DEGREE_STEP)])
 for el in xrange(ELEVATION_MIN, ELEVATION_MAX + 1):
-    print el, ',', ','.join([ str(az_offset[el][az]) if az_offset[el][az] is not None else ''
-                     for az in xrange(AZIMUTH_MIN, AZIMUTH_MAX + 1, 3)] )
-
+    print el, ',', ','.join([ '{:.2f}'.format(cell(el, az)) if cell(el, az) is not None else ''
+                     for az in xrange(AZIMUTH_MIN, AZIMUTH_MAX + 1, DEGREE_STEP)] )
@@ -1,9 +1,20 @@
 #!/usr/bin/env python2
 
+import collections
+import datetime
 import logging
+import math
+import numpy as np
+import os
 import serial
 import struct
+import sys
 import time
+import types
+
+from calibration import load_calibrations
+from compensation import CompensationTable, COMPENSATION_FILE
+from metrics import ControllerMetrics
 
 logging.basicConfig(format="[%(asctime)s] %(levelname)s %(filename)s(%(lineno)d) %(message)s",
                     level=logging.INFO)
@@ -28,6 +39,18 @@ class LinearInterp(object):
 az_interp = LinearInterp('AZ', 2.4459, 114.4)
 el_interp = LinearInterp('EL', 0.8264, 10.358)
 
+def calibrated_interps(azimuth=None, elevation=None, calibration=None):
+    """Return the (azimuth, elevation) mappings to use: those given,
+    else the ones fitted and saved in the calibration file (if one is
+    given and exists), else az_interp and el_interp.
+    """
+    fitted = { }
+    if calibration is not None and os.path.exists(calibration):
+        fitted = load_calibrations(calibration)
+        logger.info("Loaded %s calibration from %s", ' and '.join(sorted(fitted)), calibration)
+    return (azimuth if azimuth is not None else fitted.get('azimuth', az_interp),
+            elevation if elevation is not None else fitted.get('elevation', el_interp))
+
 ## Device limits
 SPEED_MIN = 10
 SPEED_MAX = 21
@@ -43,6 +66,29 @@ AZIMUTH_MAX = az_interp.forward(COMPASS_AZIMUTH_MAX)
 ELEVATION_MIN = 20              # Hard limit ~10
 ELEVATION_MAX = 80              # Hard limit ~83
 
+MIRROR_ELEVATION_MIN = 0        # Mirror elevations (degrees) searched for reachable ones
+MIRROR_ELEVATION_MAX = 90
+
+def reachable(interp, low, high, reading_min, reading_max):
+    """The lowest and highest whole degrees in low-high that interp
+    maps to readings within reading_min-reading_max.
+    """
+    degrees = [value for value in range(int(low), int(high) + 1)
+               if reading_min <= interp.forward(value) <= reading_max]
+    if not degrees:
+        raise ValueError("{0} mapping reaches no reading in {1}-{2}".format(interp.name,
+                                                                             reading_min,
+                                                                             reading_max))
+    return degrees[0], degrees[-1]
+
+def compass_limits(az_interp, el_interp):
+    """((min, max) compass azimuth, (min, max) mirror elevation) that
+    the given mappings keep within the readings the Encoder accepts.
+    """
+    return (reachable(az_interp, COMPASS_AZIMUTH_MIN, COMPASS_AZIMUTH_MAX, AZIMUTH_MIN, AZIMUTH_MAX),
+            reachable(el_interp, MIRROR_ELEVATION_MIN, MIRROR_ELEVATION_MAX,
+                      ELEVATION_MIN, ELEVATION_MAX))
+
 ## Command bytes
 AZIMUTH_CMD = 0x10
 ELEVATION_CMD = 0x20
@@ -63,6 +109,54 @@ WIGGLE_AZ_DELTA = 10            # Number of degrees to wiggle azimuth.
 WIGGLE_EL_DELTA = 3             # Number of degrees to wiggle elevation.
 WRITE_TIMEOUT = 0.030           # Seconds after which port write will time out
 
+## Listening window estimation
+LISTEN_SAMPLES = 32             # Successful write times kept for estimating the window
+LISTEN_MIN_SAMPLES = 8          # Successful writes needed before we trust the estimate
+LISTEN_PERIOD_MIN = 0.1         # Shortest listening period considered (seconds)
+LISTEN_PERIOD_MAX = 2.0         # Longest listening period considered (seconds)
+LISTEN_PERIOD_STEP = 0.002      # Coarse search step for the period (seconds)
+LISTEN_CONCENTRATION = 0.8      # Min phase concentration (0-1) to accept a period
+LISTEN_HORIZON = 10.0           # Don't extrapolate the window further than this (seconds)
+LISTEN_LEAD = 2 * WRITE_TIMEOUT # Start writing this long before the predicted window
+
+## Motion model
+POLL_MIN = 0.25                 # Shortest sleep between checks (seconds)
+POLL_MAX = 10.0                 # Longest sleep between checks (seconds)
+POLL_ARRIVAL_FRACTION = 0.5     # Sleep this fraction of the predicted time to arrival
+SPEED_SMOOTHING = 0.3           # Weight of the newest measurement in the learned axis speed
+STALL_MIN_TIME = 2.0            # Never call an axis stalled sooner than this (seconds)
+STALL_UNITS = 3                 # Stalled if it hasn't moved in the time to travel this far
+STALL_TIME_UNKNOWN = MAX_CHECKS_BEFORE_WIGGLE * SLEEP_BETWEEN_CHECKS # ...until speed is known
+
+## Speed planning
+OVERSHOOT_SMOOTHING = 0.3       # Weight of the newest move in the learned overshoot
+OVERSHOOT_TOLERANCE = 0.5       # Approach no faster than this much predicted overshoot (units)
+
+## Protocol steps (see StringPotProtocol)
+WRITE = 'write'                 # (WRITE, packet): write the packet to the port
+READ = 'read'                   # (READ, size): read up to size bytes within WRITE_TIMEOUT
+SLEEP = 'sleep'                 # (SLEEP, seconds)
+POLL = 'poll'                   # (POLL, seconds): sleep between checks; the abort event ends it
+
+class SystemClock(object):
+    """Wall-clock time and real sleeps. Controllers and the tracker
+    take a clock so that a simulated one can stand in for it.
+    """
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def wait(self, event, seconds):
+        """Sleep, but wake as soon as event is set."""
+        event.wait(seconds)
+
+    def now(self, tz=None):
+        return datetime.datetime.now(tz)
+
+system_clock = SystemClock()
+
 def clamp(value, low_bound, high_bound):
     """Clamp value to be between low and high bound (inclusive)."""
     return int(max(low_bound, min(value, high_bound)))
@@ -72,6 +166,11 @@ class Encoder(struct.Struct):
     def __init__(self):
         super(Encoder, self).__init__('> 3b 1H 1b 1b 1b 1b')
 
+    def speed(self, packet):
+        """The speed a command packet asks for (zero for stop)."""
+        _, _, _, _, az_speed, _, el_speed, command = self.unpack(packet)
+        return az_speed if command == AZIMUTH_CMD else el_speed
+
     def _validate_speed(self, speed):
         if not SPEED_MIN <= speed <= SPEED_MAX:
             raise ValueError("Speed {0} out of bounds {1}-{2}".format(speed, SPEED_MIN, SPEED_MAX))
@@ -117,6 +216,216 @@ class Decoder(struct.Struct):
         logger.debug("SPAZ {azimuth} EL {elevation} TEMP {temperature} HUM {humidity}".format(**response))
         return response
 
+class FrameReader(object):
+    """Reassemble response packets from the serial byte stream.
+
+    Bytes are buffered across reads, so a response that straddles two
+    reads (or arrives after we've given up on it) is not lost. Frames
+    start with three SYNC_BYTEs; anything before that is discarded.
+    """
+    HEADER = bytearray([SYNC_BYTE] * 3)
+
+    def __init__(self, frame_len=RESPONSE_LEN):
+        self.frame_len = frame_len
+        self.buffer = bytearray()
+        self.discarded = 0      # Number of bytes dropped while resynchronizing
+
+    def clear(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer.extend(data)
+
+    def next_frame(self):
+        """Return the next complete frame, or None if there isn't one yet."""
+        start = self.buffer.find(self.HEADER)
+        if start < 0:
+            # Keep a possible partial header at the end.
+            keep = len(self.HEADER) - 1
+            self.discarded += max(0, len(self.buffer) - keep)
+            del self.buffer[:-keep]
+            return None
+        # Readings are 10-bit, so a SYNC_BYTE right after the header
+        # means we matched early on a run of them (e.g. the tail of
+        # the previous frame).
+        while (start + len(self.HEADER) < len(self.buffer) and
+               self.buffer[start + len(self.HEADER)] == SYNC_BYTE):
+            start += 1
+        if start > 0:
+            logger.debug("Resynchronizing; dropped %d bytes", start)
+            self.discarded += start
+            del self.buffer[:start]
+        if len(self.buffer) < self.frame_len:
+            return None
+        frame = bytes(self.buffer[:self.frame_len])
+        del self.buffer[:self.frame_len]
+        return frame
+
+class ListeningWindow(object):
+    """Estimate when the controller listens for commands from the
+    times of writes that got a response.
+
+    The period is the longest one (between LISTEN_PERIOD_MIN and
+    LISTEN_PERIOD_MAX) at which those times all fold onto about the
+    same phase; the window is then extrapolated from the most recent
+    success.
+    """
+    def __init__(self):
+        self.successes = collections.deque(maxlen=LISTEN_SAMPLES)
+        self.period = None
+
+    @staticmethod
+    def _concentration(times, periods):
+        """How tightly times cluster in phase for each period (1 = exactly)."""
+        angles = 2 * np.pi * times[np.newaxis, :] / periods[:, np.newaxis]
+        return np.hypot(np.cos(angles).mean(axis=1), np.sin(angles).mean(axis=1))
+
+    def record(self, when):
+        self.successes.append(when)
+        if len(self.successes) < LISTEN_MIN_SAMPLES:
+            return
+
+        times = np.array(self.successes) - self.successes[0]
+        periods = np.arange(LISTEN_PERIOD_MIN, LISTEN_PERIOD_MAX, LISTEN_PERIOD_STEP)
+        candidates = np.nonzero(self._concentration(times, periods) >= LISTEN_CONCENTRATION)[0]
+        if len(candidates) == 0:
+            self.period = None
+            return
+
+        # Refine around the longest acceptable period.
+        coarse = periods[candidates[-1]]
+        periods = np.linspace(coarse - LISTEN_PERIOD_STEP, coarse + LISTEN_PERIOD_STEP, 101)
+        self.period = periods[np.argmax(self._concentration(times, periods))]
+
+    def delay(self, now):
+        """Seconds to wait before starting to write so that the first
+        write lands just ahead of the next listening window. Zero if we
+        have no usable estimate.
+        """
+        if self.period is None or now - self.successes[-1] > LISTEN_HORIZON:
+            return 0.0
+        cycles = math.ceil((now + LISTEN_LEAD - self.successes[-1]) / self.period)
+        window = self.successes[-1] + cycles * self.period
+        return max(0.0, window - LISTEN_LEAD - now)
+
+class AxisMotion(object):
+    """Track one axis's readings during a move to estimate its
+    velocity. How fast the axis goes for each unit of commanded speed,
+    and how far it overshoots, are learned across moves and used to
+    decide when to check again, when the axis has stalled, and how
+    fast to drive it.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.rate = None        # Learned units per second per unit of commanded speed
+        self.overshoot = None   # Learned overshoot in units per unit of speed above SPEED_MIN
+        self.expected = None
+        self.command_speed = SPEED_NORMAL
+        self.reset()
+
+    def reset(self):
+        """Forget the current move's readings (but not what we've learned)."""
+        self.value = None
+        self.changed = None     # Time the reading last changed
+        self.velocity = None
+        self.direction = None   # Sign of the way to the expected value
+        self.passed = 0         # Furthest seen beyond the expected value
+
+    def start(self, expected_value, speed):
+        """Begin a move toward expected_value at the given commanded speed."""
+        self.reset()
+        self.expected = expected_value
+        self.command_speed = speed
+
+    @property
+    def speed(self):
+        """Expected speed of the current move in units per second."""
+        return self.rate * self.command_speed if self.rate else None
+
+    def update(self, value, now):
+        if self.expected is not None:
+            if self.direction is None and value != self.expected:
+                self.direction = 1 if self.expected > value else -1
+            if self.direction is not None:
+                self.passed = max(self.passed, (value - self.expected) * self.direction)
+
+        if self.value is None:
+            self.value, self.changed = value, now
+            return
+        if value == self.value:
+            self.velocity = 0.0
+        elif now > self.changed:
+            self.velocity = (value - self.value) / float(now - self.changed)
+            # Only moves toward the target (not coming back from an
+            # overshoot) show how fast the commanded speed drives it.
+            if self.expected is None or (self.expected - self.value) * self.velocity > 0:
+                rate = abs(self.velocity) / self.command_speed
+                if self.rate is None:
+                    self.rate = rate
+                else:
+                    self.rate += SPEED_SMOOTHING * (rate - self.rate)
+            self.value, self.changed = value, now
+        # A different reading at the same moment (a clock that hasn't
+        # ticked) can't give a velocity; keep the last one and measure
+        # the change at the next reading instead.
+
+    def finish(self, stopped_value):
+        """The move has arrived and the axis stopped at stopped_value;
+        learn how far it overshot. The axis is taken not to overshoot
+        at all at SPEED_MIN.
+        """
+        if self.direction is None or self.command_speed <= SPEED_MIN:
+            return
+        self.passed = max(self.passed, (stopped_value - self.expected) * self.direction)
+        overshoot = self.passed / float(self.command_speed - SPEED_MIN)
+        if self.overshoot is None:
+            self.overshoot = overshoot
+        else:
+            self.overshoot += OVERSHOOT_SMOOTHING * (overshoot - self.overshoot)
+
+    def plan(self, distance):
+        """Pick speeds for a move of distance units (None if not known).
+        Return (speed, approach, approach_speed): drive at speed until
+        within approach units of the target, then at approach_speed,
+        the fastest that shouldn't overshoot. The approach leaves room
+        for the overshoot at full speed plus one quick check's travel.
+        Until the axis has been seen to arrive, use SPEED_NORMAL.
+        """
+        if self.rate is None or self.overshoot is None:
+            return SPEED_NORMAL, 0, SPEED_NORMAL
+
+        approach_speed = SPEED_MIN
+        for speed in xrange(SPEED_MAX, SPEED_MIN - 1, -1):
+            if self.overshoot * (speed - SPEED_MIN) < OVERSHOOT_TOLERANCE:
+                approach_speed = speed
+                break
+        approach = int(math.ceil(self.overshoot * (SPEED_MAX - SPEED_MIN) +
+                                 self.rate * POLL_MIN * SPEED_MAX))
+        if approach_speed == SPEED_MAX or (distance is not None and distance <= approach):
+            return approach_speed, 0, approach_speed
+        return SPEED_MAX, approach, approach_speed
+
+    def next_poll(self, expected_value):
+        """Seconds to sleep before the next check: a fraction of the
+        predicted time to arrival, so checks get denser near the target.
+        """
+        if not self.speed:
+            return SLEEP_BETWEEN_CHECKS
+        arrival = abs(expected_value - self.value) / self.speed
+        return max(POLL_MIN, min(arrival * POLL_ARRIVAL_FRACTION, POLL_MAX))
+
+    def stalled(self, now):
+        """Has the reading stayed put for longer than moving should take?"""
+        if not self.speed:
+            allowed = STALL_TIME_UNKNOWN
+        else:
+            allowed = max(STALL_MIN_TIME, STALL_UNITS / self.speed)
+        return now - self.changed > allowed
+
+class Superseded(Exception):
+    """Raised out of a move whose target has been replaced by a newer one."""
+    pass
+
 class MockController(object):
     def __init__(self, device='/dev/ttyUSB0'):
         pass
@@ -133,52 +442,136 @@ class MockController(object):
         logger.debug("Elevation %d, speed %d", new_elevation, speed)
         return new_elevation
 
+    def move_to(self, new_azimuth, new_elevation, speed=SPEED_NORMAL):
+        logger.debug("Azimuth %d, elevation %d, speed %d", new_azimuth, new_elevation, speed)
+        return new_azimuth, new_elevation
+
+    def move_time(self, new_azimuth, new_elevation):
+        return 0.0
+
     def report_stats(self):
         logger.debug("Report statistics.")
 
 
-class StringPotController(object):
-    def __init__(self, device='/dev/ttyUSB0'):
+class Result(Exception):
+    """Raised by a protocol operation to return value, as a generator
+    can't return one.
+    """
+    def __init__(self, value=None):
+        super(Result, self).__init__(value)
+        self.value = value
+
+class StringPotProtocol(object):
+    """The controller protocol, in string-pot readings. It is shared
+    by StringPotController and AsyncStringPotController (see
+    async_controller.py), which differ only in how they talk to the
+    port and wait.
+
+    Each part of the protocol that talks to the port or waits is an
+    operation: a generator that yields the steps it needs done --
+    (WRITE, packet), (READ, size), (SLEEP, seconds), (POLL, seconds)
+    or another operation -- is sent back the result of each, and
+    raises Result with its own. A controller's run() carries an
+    operation out; stop(), azimuth(), elevation() and move_to() return
+    what run() does. The time is always the clock's.
+    """
+    def __init__(self, telemetry=None, clock=system_clock):
         self.sends = 0          # Number of messages sent
         self.writes = 0         # Number of port writes (including failed attempts to write)
         self.failed_tries = 0   # Number of times MAX_WRITES exceeded
+        self.last_attempts = 0  # Writes needed by the last successful try_to_write
+        self.last_latency = 0.0 # Seconds taken by the last successful try_to_write
+        self.latency = 0.0      # Total seconds taken by successful try_to_writes
+        self.successes = 0      # Number of successful try_to_writes
+        self.wiggles = 0        # Number of wiggles
+        self.metrics = ControllerMetrics()  # Latencies, attempts and settle times
 
-        self.port = serial.Serial(device, baudrate=BAUD_RATE, timeout=WRITE_TIMEOUT)
+        self.clock = clock
         self.encoder = Encoder()
         self.decoder = Decoder()
-        self.stop()             # Make sure we're stopped before doing anything else.
+        self.reader = FrameReader()
+        self.listening = ListeningWindow()
+        self.motion = { 'azimuth': AxisMotion('azimuth'), 'elevation': AxisMotion('elevation') }
+        self.telemetry = telemetry  # Optional TelemetryStore for every response
+        self.last_response = None   # Latest decoded response...
+        self.last_response_time = None  # ...and when its command was written
+        self.last_command = None
+        self.superseded = None  # Optional callable(metric): has this move's target been replaced?
+        self.abort = None       # Optional event, set when it has, to cut a poll short
+
+    def run(self, operation):
+        raise NotImplementedError
+
+    def raw(self, op, *args):
+        """The operation for op (stop, azimuth, elevation or move_to)
+        in string-pot readings, even on a CompassProtocol.
+        """
+        return getattr(StringPotProtocol, '_' + op)(self, *args)
 
     def report_stats(self):
         logger.info("%d commands sent", self.sends)
         logger.info("%d port writes", self.writes)
         logger.info("%d failed tries", self.failed_tries)
+        logger.info("%d wiggles", self.wiggles)
+        logger.info("%d bytes discarded", self.reader.discarded)
         if self.sends > 0:
-            logger.info("%d writes/send", self.writes/self.sends)
+            logger.info("%.2f writes/send", float(self.writes) / self.sends)
+        if self.successes > 0:
+            logger.info("%.3fs mean latency", self.latency / self.successes)
+        if self.listening.period is not None:
+            logger.info("%.3fs listening period", self.listening.period)
+        self.metrics.report()
 
-    def try_to_write(self, command):
+    def _try_to_write(self, command):
         """Write a command to the controller. The controller does't
         listen for incoming commands very often, so we try writing the
         command multiple times until the controller responds. If the
         command is written successfully, return the response from the
         controller. If we end up trying too many times, return None.
+
+        Partial responses are kept in the frame reader between writes
+        of the same command; anything left over from a previous
+        command is thrown away. Once we have learned when the
+        controller listens, wait for its next window before writing.
         """
+        if command != self.last_command:
+            self.reader.clear()
+            self.last_command = command
+
+        started = self.clock.time()
+        delay = self.listening.delay(started)
+        if delay > 0:
+            yield (SLEEP, delay)
+
         count = 1
         while True:
-            self.port.write(command)
+            written = self.clock.time()
+            yield (WRITE, command)
             self.writes += 1
-            buffer = self.port.read(RESPONSE_LEN)
-            if len(buffer) == RESPONSE_LEN:
-                logger.debug("Got response after %d tries", count)
-                response = self.decoder.decode(buffer)
-                return response
+            self.reader.feed((yield (READ, RESPONSE_LEN)))
+            frame = self.reader.next_frame()
+            if frame is not None:
+                self.listening.record(written)
+                self.last_attempts = count
+                self.last_latency = self.clock.time() - started
+                self.latency += self.last_latency
+                self.successes += 1
+                self.metrics.tried(written, self.last_latency, count, True)
+                logger.debug("Got response after %d tries (%.3fs)", count, self.last_latency)
+                response = self.decoder.decode(frame)
+                self.last_response, self.last_response_time = response, written
+                if self.telemetry is not None:
+                    self.telemetry.append(response, written)
+                raise Result(response)
             elif count >= MAX_WRITES:
                 logger.debug("Exceeded maximum writes")
                 self.failed_tries += 1
-                return None
+                self.metrics.tried(written, self.clock.time() - started, count, False)
+                raise Result(None)
             else:
                 count += 1
 
-    def send(self, command):
+    def _send(self, command):
         """Invoke try_to_write multiple times. Other methods should
         use this one to send commands and may assume that the message
         will be delivered successfully. This a convenient fiction.
@@ -188,67 +581,210 @@ class StringPotController(object):
         controller but will recover in the event of a communication
         failure.
         """
+        started = self.clock.time()
+        tries = 0
         while True:
             count = 1
             while count < MAX_SENDS:
-                response = self.try_to_write(command)
+                response = yield self._try_to_write(command)
+                tries += 1
                 if response is not None:
                     self.sends += 1
-                    return response
+                    self.metrics.sent(self.clock.time() - started, tries)
+                    raise Result(response)
                 else:
                     count += 1
 
             logger.error("Failed to send command")
+            self.metrics.send_failed()
             self.report_stats()
             logger.debug("Sleeping %ds", SLEEP_AFTER_FAILED_WRITE)
-            time.sleep(SLEEP_AFTER_FAILED_WRITE)
+            yield (SLEEP, SLEEP_AFTER_FAILED_WRITE)
 
-    def send_and_wait(self, command, which_metric, expected_value, may_wiggle=True):
+    def _send_and_wait(self, command, which_metric, expected_value, may_wiggle=True,
+                       approach=None):
         """Send a command and wait for the given metric to reach an
-        expected value.
+        expected value. The axis's motion model decides how long to
+        wait between checks and when the axis has stalled. If approach
+        is given, it is a (units, command) pair: once within that many
+        units of the expected value, switch to the second command
+        (the same move at a slower speed).
+
+        If the superseded callback says a newer target has replaced
+        this one, give up on it (without stopping) by raising Superseded.
+        Setting the abort event wakes the wait between checks to ask.
+
+        The time taken to arrive is recorded in the metrics, except for
+        moves made while wiggling (may_wiggle False), which count
+        towards the wiggle's time instead.
         """
         assert(which_metric in ('azimuth', 'elevation'))
 
+        motion = self.motion[which_metric]
+        motion.start(expected_value, self.encoder.speed(command))
         wiggle_count = 0
-        check_count = 0
-        previous_value = current_value = -1
-        while current_value != expected_value:
-            if check_count < MAX_CHECKS_BEFORE_WIGGLE:
-                response = self.send(command)
+        started = self.clock.time()
+        if may_wiggle:
+            self.metrics.moved(which_metric)
+        response = yield self._send(command)
+        while True:
+            now = self.clock.time()
+            current_value = response[which_metric]
+            motion.update(current_value, now)
+            logger.info("{0} now {1} want {2} ({3:+d})".format(which_metric,
+                                                               current_value, expected_value,
+                                                               expected_value - current_value))
+            if current_value == expected_value:
+                if may_wiggle:
+                    self.metrics.settled(which_metric, now - started)
+                break
+            self._check_superseded(which_metric)
+
+            if approach is not None and abs(expected_value - current_value) <= approach[0]:
+                command, approach = approach[1], None
+                motion.command_speed = self.encoder.speed(command)
+                logger.info("Approach %s at speed %d", which_metric, motion.command_speed)
+                response = yield self._send(command)
+                continue
+
+            if motion.stalled(now):
+                logger.warning("%s stalled at %d", which_metric, current_value)
+                if not may_wiggle:
+                    logger.debug("Wiggling disabled; giving up.")
+                    raise Result(response)
+                elif wiggle_count < MAX_WIGGLES:
+                    yield self._wiggle(which_metric, expected_value)
+                    wiggle_count += 1
+                    logger.debug("Wiggle count %d", wiggle_count)
+                    motion.start(expected_value, self.encoder.speed(command))
+                    logger.info("Done wiggling; resume %s to %d", which_metric, expected_value)
+                else:
+                    # Bottomed out with no more recovery options -- bail out.
+                    raise RuntimeError("Too many wiggles; giving up.")
+            else:
+                yield (POLL, motion.next_poll(self._checkpoint(current_value, expected_value,
+                                                               approach)))
+                self._check_superseded(which_metric)
+            response = yield self._send(command)
+        stopped = yield self._halt()
+        motion.finish(stopped[which_metric])
+        raise Result(response)
+
+    def _check_superseded(self, which_metric):
+        if self.superseded is not None and self.superseded(which_metric):
+            logger.info("Move of %s superseded; abandoning it", which_metric)
+            raise Superseded(which_metric)
+
+    @staticmethod
+    def _checkpoint(current_value, expected_value, approach):
+        """Value to poll for: the expected value, or where the
+        approach starts if we haven't got there yet.
+        """
+        if approach is None:
+            return expected_value
+        return expected_value - int(math.copysign(approach[0], expected_value - current_value))
+
+    def _send_and_wait_all(self, commands, may_wiggle=True):
+        """Like _send_and_wait(), but for both axes at once. Commands
+        maps each metric to a (command, expected value, approach)
+        triple, approach being as for _send_and_wait() or None. Every
+        command is sent, then the axes that haven't arrived are
+        re-sent and checked from the same responses (each response
+        reports both axes), so the moves overlap. Stop once every axis
+        has reached its expected value.
+        """
+        metrics = sorted(commands.keys())
+        commands = dict(commands)
+        for which_metric in metrics:
+            assert(which_metric in ('azimuth', 'elevation'))
+            command, expected_value, _ = commands[which_metric]
+            self.motion[which_metric].start(expected_value, self.encoder.speed(command))
+        wiggle_count = dict((metric, 0) for metric in metrics)
+        started = self.clock.time()
+        arrived = set()         # Axes whose settle time has been recorded
+
+        for which_metric in metrics:
+            self.metrics.moved(which_metric)
+            response = yield self._send(commands[which_metric][0])
+
+        while True:
+            now = self.clock.time()
+            pending = [ ]
+            for which_metric in metrics:
+                command, expected_value, approach = commands[which_metric]
                 current_value = response[which_metric]
+                self.motion[which_metric].update(current_value, now)
                 logger.info("{0} now {1} want {2} ({3:+d})".format(which_metric,
                                                                    current_value, expected_value,
                                                                    expected_value - current_value))
+                if current_value == expected_value:
+                    if which_metric not in arrived:
+                        arrived.add(which_metric)
+                        self.metrics.settled(which_metric, now - started)
+                    continue
+                pending.append(which_metric)
+                if approach is not None and abs(expected_value - current_value) <= approach[0]:
+                    commands[which_metric] = (approach[1], expected_value, None)
+                    self.motion[which_metric].command_speed = self.encoder.speed(approach[1])
+                    logger.info("Approach %s at speed %d", which_metric,
+                                self.motion[which_metric].command_speed)
+            if not pending:
+                break
+            for which_metric in pending:
+                self._check_superseded(which_metric)
 
-                if current_value != expected_value:
-                    # Not there yet
-                    if current_value == previous_value:
-                        # In the same place as last check
-                        check_count += 1
-                    else:
-                        # Moved since last check
-                        previous_value = current_value
-                        check_count = 0
-                    time.sleep(SLEEP_BETWEEN_CHECKS)
-            else:
-                logger.warning("Exceeded maximum checks")
-                if may_wiggle:
-                    if wiggle_count < MAX_WIGGLES:
-                        self.wiggle(which_metric, expected_value)
-                        wiggle_count += 1
-                        logger.debug("Wiggle count %d", wiggle_count)
-                        check_count = 0
-                        logger.info("Done wiggling; resume %s to %d", which_metric, expected_value)
-                    else:
-                        # Bottomed out with no more recovery options -- bail out.
-                        raise RuntimeError("Too many wiggles; giving up.")
-                else:
+            wiggled = False
+            for which_metric in pending:
+                if not self.motion[which_metric].stalled(now):
+                    continue
+                logger.warning("%s stalled at %d", which_metric, response[which_metric])
+                if not may_wiggle:
                     logger.debug("Wiggling disabled; giving up.")
-                    return response
-        self.stop()
-        return response
+                    raise Result(response)
+                elif wiggle_count[which_metric] < MAX_WIGGLES:
+                    yield self._wiggle(which_metric, commands[which_metric][1])
+                    wiggle_count[which_metric] += 1
+                    logger.debug("Wiggle count %d", wiggle_count[which_metric])
+                    wiggled = True
+                    logger.info("Done wiggling; resume %s to %d",
+                                which_metric, commands[which_metric][1])
+                else:
+                    raise RuntimeError("Too many wiggles; giving up.")
 
-    def wiggle(self, which_metric, expected_value):
+            if wiggled:
+                # Wiggling stops both axes, so start both models afresh.
+                for which_metric in pending:
+                    command, expected_value, _ = commands[which_metric]
+                    self.motion[which_metric].start(expected_value, self.encoder.speed(command))
+            else:
+                yield (POLL, min(self.motion[which_metric].next_poll(
+                                     self._checkpoint(response[which_metric],
+                                                      *commands[which_metric][1:]))
+                                 for which_metric in pending))
+                for which_metric in pending:
+                    self._check_superseded(which_metric)
+            for which_metric in pending:
+                response = yield self._send(commands[which_metric][0])
+        stopped = yield self._halt()
+        for which_metric in metrics:
+            self.motion[which_metric].finish(stopped[which_metric])
+        raise Result(response)
+
+    def move_time(self, new_azimuth, new_elevation):
+        """Predict how many seconds moving to the given position will
+        take, from the learned axis speeds and the mean latency. Axes
+        whose speed isn't known yet are taken to arrive at once.
+        """
+        seconds = 0.0
+        for which_metric, value in (('azimuth', new_azimuth), ('elevation', new_elevation)):
+            motion = self.motion[which_metric]
+            if motion.speed and motion.value is not None:
+                seconds = max(seconds, abs(value - motion.value) / motion.speed)
+        if self.successes > 0:
+            seconds += self.latency / self.successes
+        return seconds
+
+    def _wiggle(self, which_metric, expected_value):
         """When we detect that the mirror isn't moving as expected,
         this method attempts to "dislodge" the mirror.
 
@@ -258,8 +794,10 @@ class StringPotController(object):
 
         assert(which_metric in ('azimuth', 'elevation'))
         logger.info("Was trying to make %s %d; wiggling", which_metric, expected_value)
+        self.wiggles += 1
+        started = self.clock.time()
 
-        current_state = self.send(self.encoder.stop())
+        current_state = yield self._send(self.encoder.stop())
         current_value = current_state[which_metric]
         logger.info("Current %s %d", which_metric, current_value)
 
@@ -275,58 +813,250 @@ class StringPotController(object):
             command = self.encoder.elevation(wiggle_value, SPEED_NORMAL)
 
         logger.info("Wiggle %s to %d", which_metric, wiggle_value)
-        self.send_and_wait(command, which_metric, wiggle_value, may_wiggle=False)
-        
-    def stop(self):
-        """Stop the heliostat."""
+        yield self._send_and_wait(command, which_metric, wiggle_value, may_wiggle=False)
+        now = self.clock.time()
+        self.metrics.wiggled(which_metric, now, now - started)
+
+    def _halt(self):
+        """Stop the heliostat and return the controller's response."""
         logger.info("Stop")
         command = self.encoder.stop()
-        response = self.send(command)
-        az, el = response['azimuth'], response['elevation'] 
-        logger.info("Stopped at azimuth %d mirror elevation %d", az, el)
-        return (az, el)
+        response = yield self._send(command)
+        logger.info("Stopped at azimuth %d mirror elevation %d",
+                    response['azimuth'], response['elevation'])
+        raise Result(response)
 
-    def azimuth(self, new_azimuth, speed=SPEED_NORMAL):
-        """Rotate the heliostat to a new azimuth."""
-        logger.info("Change azimuth to %d, speed %d", new_azimuth, speed)
-        command = self.encoder.azimuth(new_azimuth, speed)
-        response = self.send_and_wait(command, 'azimuth', new_azimuth, may_wiggle=True)
+    def _stop(self):
+        response = yield self._halt()
+        raise Result((response['azimuth'], response['elevation']))
+
+    def _plan(self, which_metric, new_value, speed):
+        """Command (and approach, for _send_and_wait()) to move an axis
+        to new_value, at the given speed or, if that is None, at speeds
+        planned from the axis's learned dynamics.
+        """
+        encode = self.encoder.azimuth if which_metric == 'azimuth' else self.encoder.elevation
+        if speed is not None:
+            return encode(new_value, speed), None
+
+        motion = self.motion[which_metric]
+        distance = abs(new_value - motion.value) if motion.value is not None else None
+        speed, approach, approach_speed = motion.plan(distance)
+        logger.debug("Plan %s: speed %d, approach %d at speed %d",
+                     which_metric, speed, approach, approach_speed)
+        if approach == 0:
+            return encode(new_value, speed), None
+        return encode(new_value, speed), (approach, encode(new_value, approach_speed))
+
+    def _azimuth(self, new_azimuth, speed=None):
+        logger.info("Change azimuth to %d, speed %s", new_azimuth, speed)
+        command, approach = self._plan('azimuth', new_azimuth, speed)
+        response = yield self._send_and_wait(command, 'azimuth', new_azimuth, may_wiggle=True,
+                                             approach=approach)
         logger.info("Azimuth now %d", response['azimuth'])
-        return (response['azimuth'], response['elevation'])
+        raise Result((response['azimuth'], response['elevation']))
 
-    def elevation(self, new_elevation, speed=SPEED_NORMAL):
-        """Tip the heliostat to a new elevation."""
-        logger.info("Change elevation to %d, speed %d", new_elevation, speed)
-        command = self.encoder.elevation(new_elevation, speed)
-        response = self.send_and_wait(command, 'elevation', new_elevation, may_wiggle=True)
+    def _elevation(self, new_elevation, speed=None):
+        logger.info("Change elevation to %d, speed %s", new_elevation, speed)
+        command, approach = self._plan('elevation', new_elevation, speed)
+        response = yield self._send_and_wait(command, 'elevation', new_elevation, may_wiggle=True,
+                                             approach=approach)
         logger.info("Elevation now %d", response['elevation'])
-        return (response['azimuth'], response['elevation'])
+        raise Result((response['azimuth'], response['elevation']))
 
-class CompassController(StringPotController):
-    @staticmethod
-    def clamp_azimuth_elevation(azimuth, elevation):
-        return (clamp(azimuth, COMPASS_AZIMUTH_MIN, COMPASS_AZIMUTH_MAX),
-                clamp(elevation, ELEVATION_MIN, ELEVATION_MAX))
+    def _move_to(self, new_azimuth, new_elevation, speed=None):
+        logger.info("Change azimuth to %d and elevation to %d, speed %s",
+                    new_azimuth, new_elevation, speed)
+        az_command, az_approach = self._plan('azimuth', new_azimuth, speed)
+        el_command, el_approach = self._plan('elevation', new_elevation, speed)
+        commands = { 'azimuth': (az_command, new_azimuth, az_approach),
+                     'elevation': (el_command, new_elevation, el_approach) }
+        response = yield self._send_and_wait_all(commands, may_wiggle=True)
+        logger.info("Azimuth now %d elevation now %d", response['azimuth'], response['elevation'])
+        raise Result((response['azimuth'], response['elevation']))
 
     def stop(self):
-        az, el = super(CompassController, self).stop()
-        az = az_interp.reverse(az)
+        """Stop the heliostat."""
+        return self.run(self._stop())
+
+    def azimuth(self, new_azimuth, speed=None):
+        """Rotate the heliostat to a new azimuth. Without a speed,
+        plan one from the axis's learned dynamics.
+        """
+        return self.run(self._azimuth(new_azimuth, speed))
+
+    def elevation(self, new_elevation, speed=None):
+        """Tip the heliostat to a new elevation. Without a speed, plan
+        one from the axis's learned dynamics.
+        """
+        return self.run(self._elevation(new_elevation, speed))
+
+    def move_to(self, new_azimuth, new_elevation, speed=None):
+        """Rotate and tip the heliostat at the same time."""
+        return self.run(self._move_to(new_azimuth, new_elevation, speed))
+
+class StringPotController(StringPotProtocol):
+    """The protocol on a blocking serial port: each operation holds
+    the calling thread until it is done.
+    """
+    def __init__(self, device='/dev/ttyUSB0', telemetry=None, clock=system_clock):
+        """Device is a serial device path, or an already open port
+        (anything with write() and read()) such as a SimulatedPort.
+        """
+        super(StringPotController, self).__init__(telemetry, clock)
+        if isinstance(device, basestring):
+            self.port = serial.Serial(device, baudrate=BAUD_RATE, timeout=WRITE_TIMEOUT)
+        else:
+            self.port = device
+        self.stop()             # Make sure we're stopped before doing anything else.
+
+    def run(self, operation):
+        """Carry out a protocol operation and return its result."""
+        value, error = None, None
+        while True:
+            try:
+                step = operation.throw(*error) if error else operation.send(value)
+            except Result as result:
+                return result.value
+            except StopIteration:
+                return None
+            value, error = None, None
+            try:
+                if isinstance(step, types.GeneratorType):
+                    value = self.run(step)
+                else:
+                    value = self._do(*step)
+            except Exception:
+                error = sys.exc_info()
+
+    def _do(self, step, argument):
+        if step == WRITE:
+            self.port.write(argument)
+        elif step == READ:
+            return self.port.read(argument)
+        elif step == POLL and self.abort is not None:
+            self.clock.wait(self.abort, argument)
+        else:
+            self.clock.sleep(argument)
+
+    def try_to_write(self, command):
+        return self.run(self._try_to_write(command))
+
+    def send(self, command):
+        return self.run(self._send(command))
+
+    def send_and_wait(self, command, which_metric, expected_value, may_wiggle=True,
+                      approach=None):
+        return self.run(self._send_and_wait(command, which_metric, expected_value, may_wiggle,
+                                            approach))
+
+    def send_and_wait_all(self, commands, may_wiggle=True):
+        return self.run(self._send_and_wait_all(commands, may_wiggle))
+
+    def wiggle(self, which_metric, expected_value):
+        return self.run(self._wiggle(which_metric, expected_value))
+
+class CompassProtocol(StringPotProtocol):
+    """The protocol in compass azimuth and mirror elevation, mapped to
+    string-pot readings by az_interp and el_interp -- by default, the
+    fitted ones in the calibration file if one is given, else the
+    fixed ones. The compass azimuth and mirror elevation limits are
+    narrowed to what those mappings keep within the readings the
+    Encoder accepts.
+
+    If there is a compensation table (see compensation.py), azimuth
+    readings are corrected for their drift with elevation: moves aim
+    for the reading the azimuth will settle on at the elevation it ends
+    up at, and readings are corrected before being reported.
+
+    A controller calls _load_mappings() before the protocol's __init__.
+    """
+    def _load_mappings(self, az_interp, el_interp, calibration, compensation):
+        self.az_interp, self.el_interp = calibrated_interps(az_interp, el_interp, calibration)
+        self.limits = compass_limits(self.az_interp, self.el_interp)
+        self.compensation = None
+        if compensation is not None and os.path.exists(compensation):
+            self.compensation = CompensationTable.load(compensation)
+            logger.info("Loaded azimuth compensation from %s", compensation)
+        self.readings = (None, None)    # Last string-pot azimuth and elevation
+
+    def azimuth_elevation_limits(self):
+        return self.limits
+
+    def clamp_azimuth_elevation(self, azimuth, elevation):
+        (az_min, az_max), (el_min, el_max) = self.limits
+        return (clamp(azimuth, az_min, az_max), clamp(elevation, el_min, el_max))
+
+    def _azimuth_reading(self, compass_azimuth, elevation_reading):
+        """Azimuth reading to aim for with the elevation at
+        elevation_reading, kept within the readings the Encoder accepts.
+        """
+        reading = self.az_interp.forward(compass_azimuth)
+        if self.compensation is not None and elevation_reading is not None:
+            reading = clamp(reading + self.compensation.drift(elevation_reading, reading),
+                            AZIMUTH_MIN, AZIMUTH_MAX)
+        return reading
+
+    def _compass_azimuth(self, azimuth_reading, elevation_reading):
+        if self.compensation is not None:
+            azimuth_reading = clamp(
+                azimuth_reading - self.compensation.drift(elevation_reading, azimuth_reading),
+                AZIMUTH_MIN, AZIMUTH_MAX)
+        return self.az_interp.reverse(azimuth_reading)
+
+    def position(self):
+        """Compass azimuth and mirror elevation as of the latest
+        response (without asking the controller).
+        """
+        az, el = self.last_response['azimuth'], self.last_response['elevation']
+        return (self._compass_azimuth(az, el), self.el_interp.reverse(el))
+
+    def move_time(self, compass_azimuth, mirror_elevation):
+        elevation_reading = self.el_interp.forward(mirror_elevation)
+        return super(CompassProtocol, self).move_time(
+            self._azimuth_reading(compass_azimuth, elevation_reading), elevation_reading)
+
+    def _stop(self):
+        az, el = self.readings = yield super(CompassProtocol, self)._stop()
+        az = self._compass_azimuth(az, el)
         logger.info("Stopped at compass azimuth %d mirror elevation %d", az, el)
-        return (az, el)
+        raise Result((az, el))
 
-    def azimuth(self, compass_azimuth, speed=SPEED_NORMAL):
-        logger.info("Change compass azimuth to %d, speed %d", compass_azimuth, speed)
-        az, el = super(CompassController, self).azimuth(az_interp.forward(compass_azimuth), speed)
-        az = az_interp.reverse(az)
+    def _azimuth(self, compass_azimuth, speed=None):
+        logger.info("Change compass azimuth to %d, speed %s", compass_azimuth, speed)
+        az, el = self.readings = yield super(CompassProtocol, self)._azimuth(
+            self._azimuth_reading(compass_azimuth, self.readings[1]), speed)
+        az = self._compass_azimuth(az, el)
         logger.info("Compass azimuth now %d", az)
-        return (az, el)
+        raise Result((az, el))
 
-    def elevation(self, mirror_elevation, speed=SPEED_NORMAL):
-        logger.info("Change mirror elevation to %d, speed %d", mirror_elevation, speed)
-        az, el = super(CompassController, self).elevation(el_interp.forward(mirror_elevation), speed)
-        el = el_interp.reverse(el)
+    def _elevation(self, mirror_elevation, speed=None):
+        logger.info("Change mirror elevation to %d, speed %s", mirror_elevation, speed)
+        az, el = self.readings = yield super(CompassProtocol, self)._elevation(
+            self.el_interp.forward(mirror_elevation), speed)
+        if self.compensation is not None:
+            logger.info("Compass azimuth now %d", self._compass_azimuth(az, el))
+        el = self.el_interp.reverse(el)
         logger.info("Mirror elevation now %d", el)
-        return (az, el)
+        raise Result((az, el))
+
+    def _move_to(self, compass_azimuth, mirror_elevation, speed=None):
+        logger.info("Change compass azimuth to %d and mirror elevation to %d, speed %s",
+                    compass_azimuth, mirror_elevation, speed)
+        elevation_reading = self.el_interp.forward(mirror_elevation)
+        az, el = self.readings = yield super(CompassProtocol, self)._move_to(
+            self._azimuth_reading(compass_azimuth, elevation_reading), elevation_reading, speed)
+        az, el = self._compass_azimuth(az, el), self.el_interp.reverse(el)
+        logger.info("Compass azimuth now %d mirror elevation now %d", az, el)
+        raise Result((az, el))
+
+class CompassController(CompassProtocol, StringPotController):
+    """CompassProtocol on a blocking serial port."""
+    def __init__(self, device='/dev/ttyUSB0', az_interp=None, el_interp=None,
+                 telemetry=None, clock=system_clock, calibration=None,
+                 compensation=COMPENSATION_FILE):
+        self._load_mappings(az_interp, el_interp, calibration, compensation)
+        super(CompassController, self).__init__(device, telemetry, clock)
 
 logger.info("Azimuth range %d-%d", COMPASS_AZIMUTH_MIN, COMPASS_AZIMUTH_MAX)
 logger.info("Elevation range %d-%d", ELEVATION_MIN, ELEVATION_MAX)
@@ -0,0 +1,235 @@
+"""In-process metrics for the controller, exported as Prometheus text.
+
+The controller records what each try_to_write, send, move and wiggle
+cost as it goes: a bucket increment and a couple of additions apiece,
+so it can be left on all the time. Histograms use fixed buckets, as
+Prometheus's do, and quantiles are estimated from them the same way.
+
+Counts of tries, failures and wiggles are also kept for each of the
+last HOURS_KEPT hours, so report_stats() can show when things went
+wrong, not just how often.
+
+The metrics are served at /metrics by the status API, or can be
+written to a file for node_exporter's textfile collector.
+
+Only the controller's own thread records. Other threads may render at
+any time; a render may be a few observations behind in places.
+"""
+
+from __future__ import division
+
+import bisect
+import collections
+import datetime
+import os
+
+import logging
+logger = logging.getLogger(__name__)
+
+PREFIX = 'heliostat_'
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+HOURS_KEPT = 24                 # Hours of hourly counts kept
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)        # try_to_write (seconds)
+WRITE_BUCKETS = (1, 2, 3, 5, 10, 20, 50)                               # Port writes per try
+SEND_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 120.0) # send (seconds)
+TRY_BUCKETS = (1, 2, 3, 5, 10, 20)                                     # try_to_writes per send
+SETTLE_BUCKETS = (1, 2, 5, 10, 20, 30, 60, 120, 300, 600)              # Moves and wiggles (seconds)
+
+class Counter(object):
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+class Histogram(object):
+    """Counts of observations at or below each of bounds (and above them all)."""
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    def quantile(self, q):
+        """Estimate the q quantile, interpolating within its bucket;
+        the top bound if it falls above them all.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        below = 0
+        for i, count in enumerate(self.counts[:-1]):
+            if below + count >= rank and count:
+                low = self.bounds[i - 1] if i else 0.0
+                return low + (self.bounds[i] - low) * (rank - below) / count
+            below += count
+        return self.bounds[-1]
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            yield name + '_bucket', labels + (('le', '{0:g}'.format(bound)),), cumulative
+        yield name + '_bucket', labels + (('le', '+Inf'),), self.count
+        yield name + '_sum', labels, self.sum
+        yield name + '_count', labels, self.count
+
+class Family(object):
+    """A named metric, with a child for each combination of label values."""
+    def __init__(self, name, kind, help, make, label_names=()):
+        self.name = PREFIX + name
+        self.kind = kind
+        self.help = help
+        self.make = make
+        self.label_names = tuple(label_names)
+        self.children = { }
+        if not self.label_names:
+            self.children[()] = make()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            assert len(values) == len(self.label_names)
+            child = self.children[values] = self.make()
+        return child
+
+    def render(self):
+        lines = ["# HELP {0} {1}".format(self.name, self.help),
+                 "# TYPE {0} {1}".format(self.name, self.kind)]
+        for values, child in sorted(self.children.items()):
+            labels = tuple(zip(self.label_names, values))
+            for name, labels, value in child.samples(self.name, labels):
+                lines.append(_sample(name, labels, value))
+        return lines
+
+def _sample(name, labels, value):
+    if labels:
+        name += '{' + ','.join('{0}="{1}"'.format(label, value) for label, value in labels) + '}'
+    return "{0} {1!r}".format(name, value)
+
+class HourlyCounts(object):
+    """Counts of named events in each of the last hours hours."""
+    def __init__(self, hours=HOURS_KEPT):
+        self.hours = collections.deque(maxlen=hours)    # (hour since the epoch, Counter of names)
+
+    def add(self, when, name, amount=1):
+        hour = int(when // 3600)
+        if not self.hours or self.hours[-1][0] != hour:
+            self.hours.append((hour, collections.Counter()))
+        self.hours[-1][1][name] += amount
+
+class ControllerMetrics(object):
+    """What a controller's commands cost; see StringPotController."""
+    def __init__(self, hours=HOURS_KEPT):
+        self.families = [ ]
+        self.tries = self._family(
+            'try_to_write_seconds', 'histogram',
+            "Time taken by try_to_write, including waiting for the listening window.",
+            lambda: Histogram(LATENCY_BUCKETS), ('result',))
+        self.writes = self._family(
+            'try_to_write_writes', 'histogram', "Port writes made by each try_to_write.",
+            lambda: Histogram(WRITE_BUCKETS), ('result',))
+        self.sends = self._family(
+            'send_seconds', 'histogram', "Time taken by send, including sleeps after failures.",
+            lambda: Histogram(SEND_BUCKETS))
+        self.send_tries = self._family(
+            'send_tries', 'histogram', "try_to_writes made by each send.",
+            lambda: Histogram(TRY_BUCKETS))
+        self.send_failures = self._family(
+            'send_failures_total', 'counter', "Times send gave up and slept.", Counter)
+        self.moves = self._family(
+            'moves_total', 'counter', "Moves of each axis started.", Counter, ('axis',))
+        self.settles = self._family(
+            'settle_seconds', 'histogram', "Time from sending a move to the axis reaching its target.",
+            lambda: Histogram(SETTLE_BUCKETS), ('axis',))
+        self.wiggles = self._family(
+            'wiggle_seconds', 'histogram', "Time taken by each wiggle of a stalled axis.",
+            lambda: Histogram(SETTLE_BUCKETS), ('axis',))
+        self.hourly = HourlyCounts(hours)
+
+    def _family(self, *args):
+        family = Family(*args)
+        self.families.append(family)
+        return family
+
+    def tried(self, when, seconds, writes, ok):
+        result = 'ok' if ok else 'failed'
+        self.tries.labels(result).observe(seconds)
+        self.writes.labels(result).observe(writes)
+        self.hourly.add(when, 'tries')
+        if not ok:
+            self.hourly.add(when, 'failed')
+
+    def sent(self, seconds, tries):
+        self.sends.labels().observe(seconds)
+        self.send_tries.labels().observe(tries)
+
+    def send_failed(self):
+        self.send_failures.labels().inc()
+
+    def moved(self, axis):
+        self.moves.labels(axis).inc()
+
+    def settled(self, axis, seconds):
+        self.settles.labels(axis).observe(seconds)
+
+    def wiggled(self, axis, when, seconds):
+        self.wiggles.labels(axis).observe(seconds)
+        self.hourly.add(when, 'wiggles')
+
+    def render(self):
+        """The metrics in Prometheus text format."""
+        lines = [ ]
+        for family in self.families:
+            lines.extend(family.render())
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Write the metrics to path, replacing it atomically."""
+        temporary = path + '.tmp'
+        with open(temporary, 'w') as f:
+            f.write(self.render())
+        os.rename(temporary, path)
+
+    def report(self, log=logger.info):
+        """Log a summary of the metrics."""
+        for result in ('ok', 'failed'):
+            tries = self.tries.children.get((result,))
+            if tries is not None:
+                log("try_to_write %s: %d, %s; writes mean %.1f, p90 %.0f", result, tries.count,
+                    _quantiles(tries), self.writes.labels(result).mean(),
+                    self.writes.labels(result).quantile(0.9))
+        sends = self.sends.labels()
+        if sends.count:
+            log("send: %d, %s; tries mean %.2f, p99 %.1f", sends.count, _quantiles(sends),
+                self.send_tries.labels().mean(), self.send_tries.labels().quantile(0.99))
+        for (axis,), moves in sorted(self.moves.children.items()):
+            settles = self.settles.labels(axis)
+            wiggles = self.wiggles.labels(axis)
+            log("%s: %d moves, %d settled (%s), %d wiggles (%.3f/move)", axis, moves.value,
+                settles.count, _quantiles(settles), wiggles.count,
+                wiggles.count / moves.value if moves.value else 0.0)
+        for hour, counts in list(self.hourly.hours):
+            if counts['tries']:
+                log("%s: %d tries, %d failed (%.1f%%), %d wiggles",
+                    datetime.datetime.fromtimestamp(hour * 3600).strftime('%Y-%m-%d %H:00'),
+                    counts['tries'], counts['failed'], 100.0 * counts['failed'] / counts['tries'],
+                    counts['wiggles'])
+
+def _quantiles(histogram):
+    if not histogram.count:
+        return "no times"
+    return "p50 {0:.3f}s p90 {1:.3f}s p99 {2:.3f}s".format(
+        *[histogram.quantile(q) for q in (0.5, 0.9, 0.99)])
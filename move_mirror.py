@@ -1,4 +1,4 @@
-from heliostat import CompassController, SPEED_NORMAL
+from daemon import DaemonClient
 import argparse
 
 parser = argparse.ArgumentParser(description='Mirror mover utility')
@@ -6,23 +6,28 @@ parser = argparse.ArgumentParser(description='Mirror mover utility')
 parser.add_argument('--azimuth', dest='azimuth', type=int, help='rotate to new azimuth')
 parser.add_argument('--elevation', dest='elevation', type=int, help='tip to new elevation')
 parser.add_argument('--stop', dest='stop', action='store_true', help='send stop command')
-parser.add_argument('--speed', dest='speed', type=int, default=SPEED_NORMAL, help='set speed')
+parser.add_argument('--speed', dest='speed', type=int, default=None,
+                    help='set speed (default: planned by the daemon)')
+parser.add_argument('--wait', dest='wait', action='store_true',
+                    help='wait for the move to finish')
 
 args = parser.parse_args()
-controller = None
+controller = DaemonClient(wait=args.wait)
 
 try:
-    controller = CompassController()
-
     if args.stop:
-        controller.stop()
+        print controller.stop()
     else:
-        if args.azimuth is not None:
-            controller.azimuth(args.azimuth, args.speed)
-        if args.elevation is not None:
-            controller.elevation(args.elevation, args.speed)
+        if args.azimuth is not None and args.elevation is not None:
+            print controller.move_to(args.azimuth, args.elevation, args.speed)
+        elif args.azimuth is not None:
+            print controller.azimuth(args.azimuth, args.speed)
+        elif args.elevation is not None:
+            print controller.elevation(args.elevation, args.speed)
+        else:
+            print controller.position()
 except KeyboardInterrupt:
     print "\nCaught keyboard interrupt; sending stop comand."
     controller.stop()
 finally:
-    controller.report_stats()
+    controller.close()
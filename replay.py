@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+
+"""Replay sun tracking over many days, faster than real time.
+
+Runs track() against a ControllerModel behind a SimulatedPort, with a
+SimulatedClock in place of the wall clock, and reports for each day
+the commands sent, how far the motors travelled, how far the mirror
+pointed from where it should have, and how often it had to wiggle.
+
+Pointing error is the angle between the mirror's actual normal and the
+one that would reflect the sun's true (unrounded, but clamped to the
+mirror's limits) position, sampled every SAMPLE_INTERVAL seconds while
+the sun is up. With --lead, the lagging tracker is replayed too and
+the two mean errors compared. With --budget or --deadband, each
+tracking policy given is replayed in turn and their commands per day
+and pointing errors compared.
+"""
+
+from __future__ import division
+
+from astral import City
+import argparse
+import calendar
+import datetime
+import random
+
+import numpy as np
+
+from ephemeris import mirror_elevation_range
+from heliostat import CompassController, AZIMUTH_MIN, AZIMUTH_MAX
+from simulator import ControllerModel, SimulatedClock, SimulatedPort
+from solar_finders import AstralSolarFinder, CorrectedAstralSolarFinder
+from solar_position import solar_position
+from solar_finders import mirror_elevation
+from track_sun import track, TrackingPolicy, LEAD_FRACTION
+
+import logging
+logger = logging.getLogger(__name__)
+
+SAMPLE_INTERVAL = 60            # Seconds between pointing error samples
+RESOLUTION = 10                 # Seconds between ephemeris entries (coarser than live)
+
+def epoch_seconds(when):
+    return calendar.timegm(when.utctimetuple())
+
+def angle_between(az1, el1, az2, el2):
+    """Angle in degrees between the directions (az1, el1) and (az2, el2)."""
+    az1, el1, az2, el2 = [np.radians(value) for value in (az1, el1, az2, el2)]
+    cosine = np.sin(el1) * np.sin(el2) + np.cos(el1) * np.cos(el2) * np.cos(az1 - az2)
+    return np.degrees(np.arccos(np.clip(cosine, -1, 1)))
+
+class ReplayClock(SimulatedClock):
+    """SimulatedClock that calls sample(when) every interval seconds
+    of simulated time as it passes.
+    """
+    def __init__(self, start, interval, sample):
+        super(ReplayClock, self).__init__(start)
+        self.interval = interval
+        self.sample = sample
+        self.next_sample = start
+
+    def advance(self, seconds):
+        until = self.current + max(0.0, seconds)
+        while self.next_sample <= until:
+            self.current = self.next_sample
+            self.sample(self.next_sample)
+            self.next_sample += self.interval
+        self.current = until
+
+class Replay(object):
+    def __init__(self, finder, start_date, days, sticky_per_day=0, drop_rate=0.0, seed=None,
+                 lead=None, policy=None):
+        """Replay days days of tracking from local midnight on start_date.
+        Each day, sticky_per_day spots where the azimuth sticks are
+        scattered at random along its range. Lead and policy are passed
+        to track().
+        """
+        self.finder = finder
+        self.lead = lead
+        self.policy = policy
+        self.tz = finder.location.tz
+        self.sticky_per_day = sticky_per_day
+        self.random = random.Random(seed)
+
+        midnight = datetime.datetime.combine(start_date, datetime.time())
+        self.start = epoch_seconds(self.tz.localize(midnight))
+        self.end = epoch_seconds(self.tz.localize(midnight + datetime.timedelta(days=days)))
+
+        self.days = [ ]         # One dict of statistics per day replayed
+        self.day = None
+        self.controller = None  # Not sampled until it's been set up
+        self.clock = ReplayClock(self.start, SAMPLE_INTERVAL, self.sample)
+        self.model = ControllerModel(now=self.start)
+        self.port = SimulatedPort(self.model, self.clock, drop_rate=drop_rate, seed=seed)
+        self.controller = CompassController(self.port, clock=self.clock, calibration=None,
+                                            compensation=None)
+
+    def run(self):
+        track(self.controller, self.finder, self.clock, until=self.end, resolution=RESOLUTION,
+              lead=self.lead, policy=self.policy)
+        self.clock.advance(self.end - self.clock.time())
+        self._end_day()
+        return self.days
+
+    def _counters(self):
+        return { 'commands': self.controller.sends,
+                 'writes': self.controller.writes,
+                 'wiggles': self.controller.wiggles,
+                 'az_travel': self.model.travel['azimuth'],
+                 'el_travel': self.model.travel['elevation'] }
+
+    def _start_day(self, date, when):
+        """Work out where the mirror should point at each sample time
+        from when to the end of the (local) day.
+        """
+        midnight = datetime.datetime.combine(date + datetime.timedelta(days=1), datetime.time())
+        until = min(epoch_seconds(self.tz.localize(midnight)), self.end)
+        stamps = np.arange(when, until, SAMPLE_INTERVAL)
+        location = self.finder.location
+
+        limits = self.controller.azimuth_elevation_limits()
+        (az_min, az_max), _ = limits
+        el_low, el_high = mirror_elevation_range(limits)
+        azimuth, solar_elevation = solar_position(stamps, location.latitude, location.longitude)
+        self.day = { 'date': date,
+                     'start': self._counters(),
+                     'up': solar_elevation > 0,
+                     'azimuth': np.clip(azimuth, az_min, az_max),
+                     'elevation': np.clip(mirror_elevation(solar_elevation), el_low, el_high),
+                     'actual': [ ] }
+
+        for _ in range(self.sticky_per_day):
+            spot = self.random.randint(AZIMUTH_MIN, AZIMUTH_MAX)
+            self.model.sticky.setdefault('azimuth', [ ]).append(spot)
+
+    def _end_day(self):
+        day, self.day = self.day, None
+        if day is None:
+            return
+        end = self._counters()
+        stats = dict((name, end[name] - day['start'][name]) for name in end)
+
+        actual = np.array(day['actual'])
+        count = len(actual)
+        up = day['up'][:count]
+        azimuth, elevation = day['azimuth'][:count][up], day['elevation'][:count][up]
+        error = angle_between(azimuth, elevation, actual[up, 0], actual[up, 1])
+        stats['date'] = day['date']
+        stats['mean_error'] = error.mean() if len(error) else 0.0
+        stats['max_error'] = error.max() if len(error) else 0.0
+        stats['az_error'] = np.abs(azimuth - actual[up, 0]).mean() if len(error) else 0.0
+        stats['el_error'] = np.abs(elevation - actual[up, 1]).mean() if len(error) else 0.0
+        self.days.append(stats)
+        logger.info("{date} {commands} commands, {mean_error:.2f} mean error".format(**stats))
+
+    def sample(self, when):
+        if self.controller is None or when >= self.end:
+            return
+        date = datetime.datetime.fromtimestamp(when, self.tz).date()
+        if self.day is None or date != self.day['date']:
+            self._end_day()
+            self._start_day(date, when)
+
+        self.model.move(when)
+        position = self.model.position
+        self.day['actual'].append(((position['azimuth'] - self.controller.az_interp.intercept) /
+                                   self.controller.az_interp.slope,
+                                   (position['elevation'] - self.controller.el_interp.intercept) /
+                                   self.controller.el_interp.slope))
+
+COLUMNS = (('date', '{0:%Y-%m-%d}', 'date'),
+           ('commands', '{0:d}', 'cmds'),
+           ('writes', '{0:d}', 'writes'),
+           ('az_travel', '{0:.0f}', 'az trvl'),
+           ('el_travel', '{0:.0f}', 'el trvl'),
+           ('mean_error', '{0:.2f}', 'mean err'),
+           ('max_error', '{0:.2f}', 'max err'),
+           ('az_error', '{0:.2f}', 'az err'),
+           ('el_error', '{0:.2f}', 'el err'),
+           ('wiggles', '{0:d}', 'wiggles'))
+
+def report(days):
+    print ' '.join('{0:>10s}'.format(heading) for _, _, heading in COLUMNS)
+    for day in days:
+        print ' '.join('{0:>10s}'.format(form.format(day[name])) for name, form, _ in COLUMNS)
+
+    total = lambda name: sum(day[name] for day in days)
+    print
+    print "{0} days: {1} commands, {2} writes, travel AZ {3:.0f} EL {4:.0f}, {5} wiggles".format(
+        len(days), total('commands'), total('writes'),
+        total('az_travel'), total('el_travel'), total('wiggles'))
+    print "Mean pointing error {0:.2f} degrees (worst {1:.2f}; AZ {2:.2f}, EL {3:.2f})".format(
+        total('mean_error') / len(days), max(day['max_error'] for day in days),
+        total('az_error') / len(days), total('el_error') / len(days))
+
+def compare_policies(results):
+    """Print a line per (policy, days) replayed."""
+    print "{0:>24s} {1:>10s} {2:>10s} {3:>10s} {4:>10s} {5:>10s}".format(
+        'policy', 'cmds/day', 'writes/day', 'az trvl/d', 'mean err', 'max err')
+    for policy, days in results:
+        mean = lambda name: sum(day[name] for day in days) / len(days)
+        print "{0:>24s} {1:10.1f} {2:10.1f} {3:10.0f} {4:10.2f} {5:10.2f}".format(
+            str(policy), mean('commands'), mean('writes'), mean('az_travel'),
+            mean('mean_error'), max(day['max_error'] for day in days))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay sun tracking against a simulated controller')
+    parser.add_argument('--start', default='2012-01-01', help='first day (YYYY-MM-DD)')
+    parser.add_argument('--days', type=int, default=365, help='number of days')
+    parser.add_argument('--finder', choices=('astral', 'corrected'), default='astral')
+    parser.add_argument('--sticky', type=int, default=0,
+                        help='sticky azimuth spots scattered each day')
+    parser.add_argument('--drop', type=float, default=0.0, help='fraction of responses dropped')
+    parser.add_argument('--seed', type=int, default=None, help='random seed')
+    parser.add_argument('--lead', type=float, nargs='?', const=LEAD_FRACTION, default=None,
+                        help='lead the sun by this fraction of the hold interval')
+    parser.add_argument('--budget', type=float, nargs='+', default=[ ],
+                        help='compare tracking policies with these pointing error budgets (degrees)')
+    parser.add_argument('--deadband', type=float, nargs=2, action='append', default=[ ],
+                        metavar=('AZ', 'EL'), help='compare a policy with these deadbands')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    upland = City(("Upland", "USA", "40°27'22\"N", "85°29'43\"W", "US/Eastern"))
+    finder = { 'astral': AstralSolarFinder,
+               'corrected': CorrectedAstralSolarFinder }[args.finder](upland)
+    start = datetime.datetime.strptime(args.start, '%Y-%m-%d').date()
+
+    policies = ([TrackingPolicy(budget=budget) for budget in args.budget] +
+                [TrackingPolicy(azimuth=az, elevation=el) for az, el in args.deadband])
+    if policies:
+        results = [ ]
+        for policy in [TrackingPolicy()] + policies:
+            results.append((policy, Replay(finder, start, args.days, args.sticky, args.drop,
+                                           args.seed, args.lead, policy).run()))
+        compare_policies(results)
+        raise SystemExit
+
+    days = Replay(finder, start, args.days, args.sticky, args.drop, args.seed, args.lead).run()
+    report(days)
+
+    if args.lead is not None:
+        lagging = Replay(finder, start, args.days, args.sticky, args.drop, args.seed).run()
+        mean = lambda days, name: sum(day[name] for day in days) / len(days)
+        for name, label in (('mean_error', 'pointing'), ('az_error', 'azimuth'),
+                            ('el_error', 'elevation')):
+            print "Mean {0} error leading {1:.2f} degrees, lagging {2:.2f} degrees".format(
+                label, mean(days, name), mean(lagging, name))
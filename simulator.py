@@ -0,0 +1,330 @@
+"""Simulated heliostat controller on a pseudo-terminal.
+
+Speaks the real byte protocol (Encoder packets in, 13-byte Decoder
+responses out) so that StringPotController can be pointed at
+``simulator.device`` and exercised end to end without the hardware.
+It models the controller's habit of only listening now and then, motor
+speeds and overshoot, dropped and split responses, and spots where an
+axis sticks until it is wiggled free.
+
+For runs faster than real time, a SimulatedPort puts the same model
+behind a stand-in for the serial port and a SimulatedClock.
+"""
+
+from __future__ import division
+
+import argparse
+import datetime
+import os
+import pty
+import random
+import select
+import threading
+import time
+import tty
+
+from heliostat import (Encoder, Decoder, AZIMUTH_CMD, ELEVATION_CMD, STOP_CMD,
+                       SYNC_BYTE, SPEED_MIN, SPEED_MAX, BAUD_RATE, WRITE_TIMEOUT)
+
+import logging
+logger = logging.getLogger(__name__)
+
+LISTEN_PERIOD = 0.4             # Seconds between listening windows
+LISTEN_TIME = 0.04              # Seconds the controller listens in each window
+RATES = { 'azimuth': 0.2,       # Reading units per second per unit of speed
+          'elevation': 0.1 }
+OVERSHOOT = { 'azimuth': 0.3,   # Units carried past the target per unit of speed
+              'elevation': 0.2 } # ...above SPEED_MIN
+TEMPERATURE_RAW = 600           # About 20C
+HUMIDITY_RAW = 470              # About 40%
+BITS_PER_BYTE = 10              # On the wire, with start and stop bits
+
+class ControllerModel(object):
+    """The controller's mechanics: where each axis is, where it is
+    headed and how fast, and where it sticks. Time is passed in, so the
+    same model runs behind a pty in real time or behind a SimulatedPort
+    in simulated time.
+    """
+    def __init__(self, azimuth=500, elevation=50, rates=RATES, sticky=None, now=0.0,
+                 overshoot=OVERSHOOT):
+        """Sticky maps an axis to readings where it will stick on the
+        way through; a stuck axis frees up (and that spot is cleared)
+        once it is commanded back the other way, as a wiggle does.
+
+        An axis arriving faster than SPEED_MIN coasts on past its
+        target (see OVERSHOOT) and is brought back at SPEED_MIN.
+        """
+        self.position = { 'azimuth': float(azimuth), 'elevation': float(elevation) }
+        self.target = { 'azimuth': None, 'elevation': None }
+        self.speed = { 'azimuth': 0, 'elevation': 0 }
+        self.stuck = { 'azimuth': None, 'elevation': None }  # Direction it stuck going
+        self.coast = { 'azimuth': None, 'elevation': None }  # Where an overshoot runs to
+        self.sticky = dict((axis, list(spots)) for axis, spots in (sticky or { }).items())
+        self.travel = { 'azimuth': 0.0, 'elevation': 0.0 }   # Reading units moved
+        self.commanded = { }    # Last (target, speed) commanded for each axis
+        self.rates = rates
+        self.overshoot = overshoot
+
+        self.encoder = Encoder()
+        self.decoder = Decoder()
+        self.commands = 0       # Commands heard
+        self._moved = now
+
+    def reading(self, axis, now):
+        self.move(now)
+        return int(round(self.position[axis]))
+
+    def move(self, now):
+        """Advance both axes to time now."""
+        elapsed, self._moved = now - self._moved, now
+        for axis in self.position:
+            self._move_axis(axis, elapsed)
+
+    def _move_axis(self, axis, elapsed):
+        """Move one axis for elapsed seconds: toward its target, on
+        past it if it coasts, and back again.
+        """
+        while elapsed > 0:
+            target = self.target[axis]
+            if target is None or self.stuck[axis] is not None or not self.speed[axis]:
+                return
+            goal = self.coast[axis] if self.coast[axis] is not None else target
+            position = self.position[axis]
+            if position == goal:
+                return
+            direction = 1 if goal > position else -1
+            rate = self.rates[axis] * self.speed[axis]
+            step = min(abs(goal - position), rate * elapsed)
+            elapsed -= step / rate
+            new_position = position + direction * step
+
+            for spot in self.sticky.get(axis, [ ]):
+                # Only spots it reaches count, not one it's leaving.
+                if 0 < (spot - position) * direction <= step and spot != target:
+                    new_position = spot
+                    self.stuck[axis] = direction
+                    logger.debug("%s stuck at %d", axis, spot)
+                    break
+            else:
+                if step == abs(goal - position):
+                    new_position = goal
+                    if self.coast[axis] is not None:
+                        # Coasted to a stop; come back slowly.
+                        self.coast[axis] = None
+                        self.speed[axis] = SPEED_MIN
+                    elif self.speed[axis] > SPEED_MIN:
+                        self.coast[axis] = target + direction * self.overshoot[axis] * (
+                            self.speed[axis] - SPEED_MIN)
+            self.travel[axis] += abs(new_position - position)
+            self.position[axis] = new_position
+
+    def command(self, packet, now):
+        """Act on a command packet heard at time now; return the response."""
+        self.move(now)
+        _, _, _, azimuth, az_speed, elevation, el_speed, command = self.encoder.unpack(packet)
+        self.commands += 1
+        if command == AZIMUTH_CMD:
+            self._set_target('azimuth', azimuth, az_speed)
+        elif command == ELEVATION_CMD:
+            self._set_target('elevation', elevation, el_speed)
+        elif command == STOP_CMD:
+            self.target = { 'azimuth': None, 'elevation': None }
+            self.coast = { 'azimuth': None, 'elevation': None }
+        return self._response()
+
+    def _set_target(self, axis, target, speed):
+        speed = max(SPEED_MIN, min(speed, SPEED_MAX))
+        direction = 1 if target > self.position[axis] else -1
+        if self.stuck[axis] is not None and direction != self.stuck[axis]:
+            # Backing off frees the axis and unsticks the spot.
+            self.sticky[axis].remove(int(round(self.position[axis])))
+            self.stuck[axis] = None
+        if (target, speed) == self.commanded.get(axis) and self.target[axis] == target:
+            return              # Same move again: carry on (e.g. back from an overshoot)
+        self.commanded[axis] = (target, speed)
+        self.coast[axis] = None
+        self.target[axis] = target
+        self.speed[axis] = speed
+
+    def _response(self):
+        return self.decoder.pack(SYNC_BYTE, SYNC_BYTE, SYNC_BYTE, 0,
+                                 int(round(self.position['elevation'])),
+                                 TEMPERATURE_RAW, HUMIDITY_RAW,
+                                 int(round(self.position['azimuth'])))
+
+class SimulatedController(object):
+    """A ControllerModel behind a pseudo-terminal, in real time."""
+    def __init__(self, azimuth=500, elevation=50, period=LISTEN_PERIOD, listen_time=LISTEN_TIME,
+                 jitter=0.0, rates=RATES, drop_rate=0.0, split_rate=0.0, sticky=None, seed=None,
+                 overshoot=OVERSHOOT):
+        self.model = ControllerModel(azimuth, elevation, rates, sticky, time.time(), overshoot)
+        self.period = period
+        self.listen_time = listen_time
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.split_rate = split_rate
+        self.random = random.Random(seed)
+
+        self.encoder = Encoder()
+        self.responses = 0      # Responses sent (including split ones)
+        self.dropped = 0        # Responses dropped
+
+        self.master, slave = pty.openpty()
+        tty.setraw(slave)
+        self.device = os.ttyname(slave)
+        self._slave = slave
+
+        self._lock = threading.Lock()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='simulator')
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def commands(self):
+        return self.model.commands
+
+    def close(self):
+        self._running = False
+        self._thread.join()
+        os.close(self.master)
+        os.close(self._slave)
+
+    def reading(self, axis):
+        with self._lock:
+            return self.model.reading(axis, time.time())
+
+    def _drain(self):
+        while select.select([self.master], [ ], [ ], 0)[0]:
+            os.read(self.master, 4096)
+
+    def _listen(self):
+        """Listen for up to listen_time; return the first complete
+        packet heard or None.
+        """
+        header = bytearray([SYNC_BYTE] * 3)
+        buffer = bytearray()
+        deadline = time.time() + self.listen_time
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([self.master], [ ], [ ], remaining)[0]:
+                return None
+            buffer.extend(os.read(self.master, 4096))
+            start = buffer.find(header)
+            if start >= 0 and len(buffer) - start >= self.encoder.size:
+                return bytes(buffer[start:start + self.encoder.size])
+
+    def _run(self):
+        next_window = time.time() + self.period
+        while self._running:
+            time.sleep(max(0, next_window - time.time()))
+            next_window += self.period + self.random.uniform(-self.jitter, self.jitter)
+
+            # Anything written while we weren't listening is lost.
+            self._drain()
+            packet = self._listen()
+            if packet is None:
+                continue
+
+            with self._lock:
+                response = self.model.command(packet, time.time())
+
+            if self.random.random() < self.drop_rate:
+                self.dropped += 1
+                continue
+            self.responses += 1
+            if self.random.random() < self.split_rate:
+                cut = self.random.randint(1, len(response) - 1)
+                os.write(self.master, response[:cut])
+                time.sleep(self.listen_time)
+                os.write(self.master, response[cut:])
+            else:
+                os.write(self.master, response)
+
+class SimulatedClock(object):
+    """Clock for running controllers and the tracker faster than real
+    time: sleeping just moves the time on.
+    """
+    def __init__(self, start=0.0):
+        self.current = float(start)
+
+    def time(self):
+        return self.current
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def wait(self, event, seconds):
+        if not event.is_set():
+            self.advance(seconds)
+
+    def advance(self, seconds):
+        self.current += max(0.0, seconds)
+
+    def now(self, tz=None):
+        return datetime.datetime.fromtimestamp(self.current, tz)
+
+class SimulatedPort(object):
+    """Stand-in for the serial port that talks to a ControllerModel in
+    simulated time. The controller hears a command written during one
+    of its listening windows (one per window) and answers at once; a
+    read with nothing to return costs WRITE_TIMEOUT, as on the real port.
+    """
+    def __init__(self, model, clock, period=LISTEN_PERIOD, listen_time=LISTEN_TIME,
+                 drop_rate=0.0, seed=None):
+        self.model = model
+        self.clock = clock
+        self.period = period
+        self.listen_time = listen_time
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+        self.buffer = bytearray()
+        self.dropped = 0        # Responses dropped
+        self._heard = None      # Last window a command was heard in
+
+    def _transmit(self, nbytes):
+        self.clock.advance(nbytes * BITS_PER_BYTE / BAUD_RATE)
+
+    def write(self, data):
+        self._transmit(len(data))
+        now = self.clock.time()
+        window, phase = divmod(now, self.period)
+        if phase > self.listen_time or window == self._heard:
+            return len(data)
+        self._heard = window
+        response = self.model.command(bytes(data), now)
+        if self.random.random() < self.drop_rate:
+            self.dropped += 1
+        else:
+            self.buffer.extend(response)
+        return len(data)
+
+    def read(self, size=1):
+        if not self.buffer:
+            self.clock.advance(WRITE_TIMEOUT)
+            return b''
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        self._transmit(len(data))
+        return data
+
+    def close(self):
+        pass
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulated heliostat controller on a pty')
+    parser.add_argument('--period', type=float, default=LISTEN_PERIOD, help='listening period')
+    parser.add_argument('--drop', type=float, default=0.0, help='fraction of responses dropped')
+    parser.add_argument('--split', type=float, default=0.0, help='fraction of responses split')
+    parser.add_argument('--stick', type=int, nargs='*', default=[ ],
+                        help='azimuth readings where the mirror sticks')
+    args = parser.parse_args()
+
+    simulator = SimulatedController(period=args.period, drop_rate=args.drop,
+                                    split_rate=args.split, sticky={ 'azimuth': args.stick })
+    print "Simulated controller on {0}".format(simulator.device)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        simulator.close()
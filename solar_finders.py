@@ -3,119 +3,221 @@ from __future__ import division
 import datetime
 import time
 
+import numpy as np
+
+from corrections import CorrectionGrid, CORRECTIONS_FILE
+from solar_position import location_solar_position
+
 MAGNETIC_DECLINATION = 5.1      # Declination in degrees at Upland, September, 2012
+SOLAR, MIRROR = 'solar', 'mirror'   # What the elevation a finder returns is
+SECONDS_PER_DAY = 86400
+DAYS_PER_YEAR = 365
 
 import logging
 logger = logging.getLogger(__name__)
 
 class Observation(object):
+    """A sighting of the sun. The time is either 'HH:MM', which applies
+    to every day of the year, or 'YYYY-MM-DD HH:MM' for a particular
+    day; a datetime works too.
+    """
     def __init__(self, time_str, azimuth, elevation):
         def time_from_string(str):
             hr, mn = [int(val) for val in str.split(':')]
             time = datetime.time(hour=hr, minute=mn)
             return time
 
-        self.time = time_from_string(time_str)
+        if isinstance(time_str, datetime.datetime):
+            self.day = time_str.timetuple().tm_yday
+            self.time = time_str.time()
+        elif ' ' in time_str:
+            date_str, time_str = time_str.split()
+            self.day = datetime.datetime.strptime(date_str, '%Y-%m-%d').timetuple().tm_yday
+            self.time = time_from_string(time_str)
+        else:
+            self.day = None
+            self.time = time_from_string(time_str)
         self.azimuth = azimuth
         self.elevation = elevation
 
     def position(self):
         return self.azimuth, self.elevation
 
+def seconds_since_midnight(when):
+    return when.hour * 3600 + when.minute * 60 + when.second + when.microsecond / 1e6
+
+def location_key(location):
+    return (location.latitude, location.longitude, location.timezone)
+
+def mirror_elevation(solar_elevation):
+    """Convert solar elevation to the elevation value for the mirror."""
+    return 90 - ((90 - solar_elevation) / 2)
+
+def solar_elevation(mirror_elevation):
+    """Convert mirror elevation back to the solar elevation."""
+    return 2 * mirror_elevation - 90
+
 class EmpiricalSolarFinder(object):
-    def __init__(self, observations):
+    """Finder that interpolates observed positions of the sun, first
+    by time of day within each observed day, then between the two
+    observed days on either side of the requested day of the year.
+
+    Observations are kept in arrays sorted on (day of year, time of
+    day), so each lookup is a binary search rather than a scan.
+    Elevation_kind says whether the observed elevations are the sun's
+    (SOLAR) or the mirror's (MIRROR).
+    """
+    def __init__(self, observations, elevation_kind=SOLAR):
+        self.elevation_kind = elevation_kind
         self.observations = [Observation(*ob) for ob in observations]
 
-    def find(self, when):
-
-        def time_delta(t1, t2):
-            """Caculate delta between two time objects in seconds. Because
-            these don't support subtraction directly, convert to datetime
-            objects first.
-            """
-            today = datetime.date.today()
-            dt1 = datetime.datetime.combine(today, t1)
-            dt2 = datetime.datetime.combine(today, t2)
-            return (dt2 - dt1).total_seconds()
-
-        azimuth_adjust = elevation_adjust = 0
-        when = when.time()      # We only need the time for this finder
-
-        if when < self.observations[0].time or when > self.observations[-1].time:
-            azimuth, elevation = self.observations[0].position()
-        else:
-            for idx in range(len(self.observations) - 1):
-                low, high = self.observations[idx], self.observations[idx + 1]
-                if (when >= low.time and when <= high.time):
-                    # Interpolate values between samples.
-                    low_to_high = time_delta(low.time, high.time)
-                    low_to_when = time_delta(low.time, when)
-                    if low_to_high == 0:
-                        fraction = 0.0
-                    else:
-                        fraction = low_to_when / low_to_high
-                    azimuth_adjust = int((high.azimuth - low.azimuth) * fraction)
-                    elevation_adjust = int((high.elevation - low.elevation) * fraction)
-
-                    azimuth, elevation = self.observations[idx].position()
-
-            azimuth = azimuth + azimuth_adjust
-            elevation = elevation + elevation_adjust
+        dated = set(ob.day is not None for ob in self.observations)
+        if len(dated) != 1:
+            raise ValueError("Observations must be all dated or all undated")
+        self.all_year = dated == set([False])
+
+        days = np.array([0 if self.all_year else ob.day for ob in self.observations])
+        seconds = np.array([seconds_since_midnight(ob.time) for ob in self.observations])
+        order = np.lexsort((seconds, days))
+
+        self.seconds = seconds[order]
+        self.keys = days[order] * SECONDS_PER_DAY + self.seconds
+        self.azimuths = np.array([ob.azimuth for ob in self.observations])[order]
+        self.elevations = np.array([ob.elevation for ob in self.observations])[order]
+
+        # Observed days and the range of rows belonging to each.
+        self.days, self.starts = np.unique(days[order], return_index=True)
+        self.ends = np.append(self.starts[1:], len(order))
+
+    @classmethod
+    def from_csv(cls, path):
+        """Load observations from lines of 'YYYY-MM-DD HH:MM,azimuth,elevation'."""
+        observations = [ ]
+        with open(path) as f:
+            for line in f:
+                when, azimuth, elevation = line.strip().split(',')
+                observations.append((when, int(azimuth), int(elevation)))
+        return cls(observations)
+
+    def cache_key(self):
+        """Value that changes whenever this finder's results would."""
+        return (self.elevation_kind,
+                tuple((ob.day, ob.time, ob.azimuth, ob.elevation) for ob in self.observations))
+
+    def _find_on_day(self, day_idx, when):
+        """Interpolate by time of day within the observed days day_idx.
+        Outside a day's observations, use its first observation.
+        """
+        low_bound, high_bound = self.starts[day_idx], self.ends[day_idx]
+        keys = self.days[day_idx] * SECONDS_PER_DAY + when
+        idx = np.searchsorted(self.keys, keys, side='right') - 1
+        idx = np.maximum(low_bound, np.minimum(idx, high_bound - 2))
+        nxt = np.minimum(idx + 1, high_bound - 1)
+
+        low_to_high = self.seconds[nxt] - self.seconds[idx]
+        fraction = np.where(low_to_high == 0, 0.0,
+                            (when - self.seconds[idx]) / np.where(low_to_high == 0, 1, low_to_high))
+        azimuth = self.azimuths[idx] + np.trunc((self.azimuths[nxt] - self.azimuths[idx]) * fraction)
+        elevation = (self.elevations[idx] +
+                     np.trunc((self.elevations[nxt] - self.elevations[idx]) * fraction))
+
+        outside = (when < self.seconds[low_bound]) | (when > self.seconds[high_bound - 1])
+        azimuth = np.where(outside, self.azimuths[low_bound], azimuth)
+        elevation = np.where(outside, self.elevations[low_bound], elevation)
+        return azimuth, elevation
 
-        return (azimuth, elevation)
+    def find(self, when):
+        azimuth, elevation = self.find_many([when])
+        return (int(azimuth[0]), int(elevation[0]))
+
+    def find_many(self, times):
+        """Vectorized find(): return arrays of azimuth and elevation
+        for a sequence of datetimes.
+        """
+        when = np.array([seconds_since_midnight(t) for t in times], dtype=float)
+        if self.all_year:
+            day_idx = np.zeros(len(when), dtype=int)
+            azimuth, elevation = self._find_on_day(day_idx, when)
+            return azimuth.astype(int), elevation.astype(int)
+
+        # Bracket each day of the year between observed days, wrapping
+        # around the end of the year.
+        day = np.array([t.timetuple().tm_yday for t in times])
+        n_days = len(self.days)
+        low_idx = np.searchsorted(self.days, day, side='right') - 1
+        high_idx = (low_idx + 1) % n_days
+        low_day = np.where(low_idx < 0, self.days[-1] - DAYS_PER_YEAR, self.days[low_idx % n_days])
+        high_day = np.where(low_idx == n_days - 1,
+                            self.days[high_idx] + DAYS_PER_YEAR, self.days[high_idx])
+        low_idx %= n_days
+
+        low_az, low_el = self._find_on_day(low_idx, when)
+        high_az, high_el = self._find_on_day(high_idx, when)
+        span = high_day - low_day
+        fraction = np.where(span == 0, 0.0, (day - low_day) / np.where(span == 0, 1, span))
+        azimuth = low_az + np.trunc((high_az - low_az) * fraction)
+        elevation = low_el + np.trunc((high_el - low_el) * fraction)
+        return azimuth.astype(int), elevation.astype(int)
 
 class CorrectedAstralSolarFinder(object):
-    """Finder using the Python Astral package -- with attempt at corrections."""
-    def __init__(self, location):
+    """Finder using the Python Astral package -- with attempt at
+    corrections. The corrections are to where the mirror had to point,
+    so the elevation it returns is the mirror's.
+    """
+    elevation_kind = MIRROR
+
+    def __init__(self, location, corrections=CORRECTIONS_FILE):
         logger.info("Location %s", location)
         self.location = location
-        self.az_correction = { }
-        self.el_correction = { }
+        self.corrections = CorrectionGrid(corrections)
 
-        with open('corrections.csv') as f:
-            for line in f:
-                line.strip()
-                which, astral, empirical = line.split(',')
-                astral = int(astral)
-                empirical = int(empirical)
-                if which == 'AZ':
-                    self.az_correction[astral] = empirical
-                elif which == 'EL':
-                    self.el_correction[astral] = empirical
-                else:
-                    raise ValueError("Invalid type of correction '{0}'".format(which))
+    def cache_key(self):
+        """Value that changes whenever this finder's results would."""
+        return (location_key(self.location), self.corrections.cache_key())
 
     def find(self, when):
-        def mirror_elevation(solar_elevation):
-            """Convert solar elevation to the elevation value for the mirror."""
-            return 90 - ((90 - solar_elevation) / 2)
-
-        def azimuth_correction(raw_az):
-            try:
-                return self.az_correction[int(raw_az)]
-            except KeyError:
-                return raw_az
-
-        def elevation_correction(raw_el):
-            try:
-                return self.el_correction[int(raw_el)]
-            except KeyError:
-                return raw_el
-            
+        # Astral's own scalar functions are much quicker than
+        # find_many() for a single time.
         when = when.replace(tzinfo=self.location.tz)
-        azimuth = int(azimuth_correction(self.location.solar_azimuth(when)) + MAGNETIC_DECLINATION)
-        elevation = int(elevation_correction(mirror_elevation(self.location.solar_elevation(when))))
-        return (azimuth, elevation)
+        raw_azimuth = self.location.solar_azimuth(when)
+        raw_elevation = self.location.solar_elevation(when)
+        azimuth, elevation = self.corrections.correct(raw_azimuth, raw_elevation,
+                                                      mirror_elevation(raw_elevation))
+        return (int(azimuth + MAGNETIC_DECLINATION), int(elevation))
+
+    def find_many(self, times):
+        """Vectorized find(): return arrays of azimuth and elevation
+        for a sequence of datetimes.
+        """
+        times = [when.replace(tzinfo=self.location.tz) for when in times]
+        raw_azimuth, raw_elevation = location_solar_position(self.location, times)
+        azimuth, elevation = self.corrections.correct(raw_azimuth, raw_elevation,
+                                                      mirror_elevation(raw_elevation))
+        azimuth += MAGNETIC_DECLINATION
+        return np.trunc(azimuth).astype(int), np.trunc(elevation).astype(int)
 
 
 class AstralSolarFinder(object):
     """Find the sun using the Python Astral package."""
+    elevation_kind = SOLAR
+
     def __init__(self, location):
         logger.info("Location %s", location)
         self.location = location
 
+    def cache_key(self):
+        """Value that changes whenever this finder's results would."""
+        return location_key(self.location)
+
     def find(self):
         azimuth = int(self.location.solar_azimuth())
         elevation = int(self.location.solar_elevation())
         return (azimuth, elevation)
 
+    def find_many(self, times):
+        """Return arrays of azimuth and elevation for a sequence of
+        datetimes (naive ones are taken as local to the location).
+        """
+        azimuth, elevation = location_solar_position(self.location, times)
+        return np.trunc(azimuth).astype(int), np.trunc(elevation).astype(int)
+
@@ -0,0 +1,133 @@
+"""Vectorized solar position engine.
+
+This implements the same NOAA equations that astral uses for
+solar_azimuth() and solar_elevation(), but operates on whole NumPy
+arrays of timestamps (and, optionally, of locations) at once.
+"""
+
+from __future__ import division
+
+import calendar
+import datetime
+
+import numpy as np
+
+SECONDS_PER_DAY = 86400.0
+JULIAN_UNIX_EPOCH = 2440587.5   # Julian day of 1970-01-01 00:00 UTC
+JULIAN_J2000 = 2451545.0        # Julian day of 2000-01-01 12:00 UTC
+DAYS_PER_CENTURY = 36525.0
+MAX_LATITUDE = 89.8             # Same clamp as astral
+
+def to_timestamps(times, tz=None):
+    """Convert a sequence of datetimes to an array of POSIX timestamps
+    (seconds since the epoch, UTC). Naive datetimes are localized to
+    tz, which must then be given. Anything that is not a datetime is
+    assumed to be a timestamp already.
+    """
+    times = list(times) if not isinstance(times, np.ndarray) else times
+    if len(times) == 0 or not isinstance(times[0], datetime.datetime):
+        return np.asarray(times, dtype=float)
+
+    stamps = np.empty(len(times), dtype=float)
+    for idx, when in enumerate(times):
+        if when.tzinfo is None:
+            if tz is None:
+                raise ValueError("Naive datetime {0} with no time zone".format(when))
+            when = tz.localize(when)
+        stamps[idx] = calendar.timegm(when.utctimetuple()) + when.microsecond / 1e6
+    return stamps
+
+def julian_day(timestamps):
+    return JULIAN_UNIX_EPOCH + np.asarray(timestamps, dtype=float) / SECONDS_PER_DAY
+
+def _sun_declination_and_eq_of_time(julian_century):
+    """Return solar declination (degrees) and the equation of time
+    (minutes) for an array of Julian centuries since J2000.
+    """
+    t = julian_century
+
+    seconds = 21.448 - t * (46.815 + t * (0.00059 - t * 0.001813))
+    mean_obliquity = 23.0 + (26.0 + (seconds / 60.0)) / 60.0
+    omega = np.radians(125.04 - 1934.136 * t)
+    obliquity = np.radians(mean_obliquity + 0.00256 * np.cos(omega))
+
+    mean_long = np.radians((280.46646 + t * (36000.76983 + 0.0003032 * t)) % 360.0)
+    mean_anomaly = np.radians(357.52911 + t * (35999.05029 - 0.0001537 * t))
+    eccentricity = 0.016708634 - t * (0.000042037 + 0.0000001267 * t)
+
+    eq_of_center = (np.sin(mean_anomaly) * (1.914602 - t * (0.004817 + 0.000014 * t)) +
+                    np.sin(2.0 * mean_anomaly) * (0.019993 - 0.000101 * t) +
+                    np.sin(3.0 * mean_anomaly) * 0.000289)
+    apparent_long = np.radians(np.degrees(mean_long) + eq_of_center -
+                               0.00569 - 0.00478 * np.sin(omega))
+    declination = np.degrees(np.arcsin(np.sin(obliquity) * np.sin(apparent_long)))
+
+    y = np.tan(obliquity / 2.0) ** 2
+    sin_m = np.sin(mean_anomaly)
+    eq_of_time = (y * np.sin(2.0 * mean_long) -
+                  2.0 * eccentricity * sin_m +
+                  4.0 * eccentricity * y * sin_m * np.cos(2.0 * mean_long) -
+                  0.5 * y * y * np.sin(4.0 * mean_long) -
+                  1.25 * eccentricity * eccentricity * np.sin(2.0 * mean_anomaly))
+    eq_of_time = np.degrees(eq_of_time) * 4.0
+
+    return declination, eq_of_time
+
+def _refraction_correction(elevation):
+    """Atmospheric refraction correction in degrees, as used by astral."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        te = np.tan(np.radians(elevation))
+        high = 58.1 / te - 0.07 / te ** 3 + 0.000086 / te ** 5
+        low = 1735.0 + elevation * (-518.2 + elevation * (103.4 + elevation *
+                                                          (-12.79 + elevation * 0.711)))
+        below = -20.774 / te
+    correction = np.where(elevation > 5.0, high, np.where(elevation > -0.575, low, below))
+    correction = np.where(elevation > 85.0, 0.0, correction)
+    return correction / 3600.0
+
+def solar_position(timestamps, latitude, longitude):
+    """Return (azimuth, elevation) arrays in degrees for the given
+    POSIX timestamps. Latitude and longitude (degrees, north and east
+    positive as in astral) may be scalars or arrays; all three
+    arguments are broadcast against each other, so passing
+    timestamps[:, np.newaxis] with arrays of locations yields one
+    column per location.
+    """
+    timestamps = np.asarray(timestamps, dtype=float)
+    latitude = np.clip(np.asarray(latitude, dtype=float), -MAX_LATITUDE, MAX_LATITUDE)
+    longitude = np.asarray(longitude, dtype=float)
+
+    julian_century = (julian_day(timestamps) - JULIAN_J2000) / DAYS_PER_CENTURY
+    declination, eq_of_time = _sun_declination_and_eq_of_time(julian_century)
+
+    utc_minutes = (timestamps % SECONDS_PER_DAY) / 60.0
+    true_solar_time = (utc_minutes + eq_of_time + 4.0 * longitude) % 1440.0
+    hour_angle = true_solar_time / 4.0 - 180.0
+
+    lat_rad = np.radians(latitude)
+    dec_rad = np.radians(declination)
+    cos_zenith = np.clip(np.sin(lat_rad) * np.sin(dec_rad) +
+                         np.cos(lat_rad) * np.cos(dec_rad) * np.cos(np.radians(hour_angle)),
+                         -1.0, 1.0)
+    zenith = np.degrees(np.arccos(cos_zenith))
+
+    az_denom = np.cos(lat_rad) * np.sin(np.radians(zenith))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        az_rad = (np.sin(lat_rad) * np.cos(np.radians(zenith)) - np.sin(dec_rad)) / az_denom
+    azimuth = 180.0 - np.degrees(np.arccos(np.clip(az_rad, -1.0, 1.0)))
+    azimuth = np.where(hour_angle > 0.0, -azimuth, azimuth)
+    azimuth = np.where(np.abs(az_denom) > 0.001, azimuth,
+                       np.where(latitude > 0.0, 180.0, 0.0))
+    azimuth = np.where(azimuth < 0.0, azimuth + 360.0, azimuth)
+
+    exoatm_elevation = 90.0 - zenith
+    elevation = exoatm_elevation + _refraction_correction(exoatm_elevation)
+
+    return azimuth, elevation
+
+def location_solar_position(location, times):
+    """Solar position for an astral Location over a sequence of
+    datetimes (naive ones are taken to be in the location's time zone).
+    """
+    return solar_position(to_timestamps(times, location.tz),
+                          location.latitude, location.longitude)
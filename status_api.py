@@ -0,0 +1,151 @@
+"""HTTP status and control API, served by the daemon beside its socket.
+
+Everything is answered from what the daemon already has -- the latest
+response the controller sent, and the telemetry store -- so status
+queries never touch the serial port. Moves and stops are handed to the
+daemon as requests, just as its socket clients send them, so they go
+through the same command queue.
+
+    GET  /status                    position, latest response, queue length
+    GET  /telemetry?seconds=&limit= recent telemetry records, streamed as JSON
+    GET  /metrics                   command latencies etc., in Prometheus text format
+    POST /move  {"azimuth": 180, "elevation": 60, "speed": null}
+    POST /stop
+"""
+
+import json
+import SocketServer
+import urlparse
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+
+import logging
+logger = logging.getLogger(__name__)
+
+HTTP_HOST = '127.0.0.1'         # Local only
+HTTP_PORT = 8080
+TELEMETRY_SECONDS = 3600        # Default span of /telemetry
+TELEMETRY_LIMIT = 10000         # Most records /telemetry returns
+STREAM_RECORDS = 500            # Records per chunk streamed
+
+STATUS = { 200: '200 OK', 202: '202 Accepted', 400: '400 Bad Request', 404: '404 Not Found',
+           405: '405 Method Not Allowed', 503: '503 Service Unavailable' }
+
+class StatusApp(object):
+    """WSGI application for a HeliostatDaemon."""
+    def __init__(self, daemon):
+        self.daemon = daemon
+        self.routes = { ('GET', '/status'): self.status,
+                        ('GET', '/telemetry'): self.telemetry,
+                        ('GET', '/metrics'): self.metrics,
+                        ('POST', '/move'): self.move,
+                        ('POST', '/stop'): self.stop }
+
+    def __call__(self, environ, start_response):
+        method, path = environ['REQUEST_METHOD'], environ.get('PATH_INFO', '/')
+        route = self.routes.get((method, path))
+        if route is None:
+            if any(known == path for _, known in self.routes):
+                code, body = 405, { 'error': "{0} not allowed on {1}".format(method, path) }
+            else:
+                code, body = 404, { 'error': "No such resource {0}".format(path) }
+        else:
+            try:
+                code, body = route(environ)
+            except (KeyError, TypeError, ValueError) as e:
+                code, body = 400, { 'error': "Bad request: {0}".format(e) }
+
+        if isinstance(body, str):
+            start_response(STATUS[code], [('Content-Type', METRICS_CONTENT_TYPE)])
+            return [body]
+        start_response(STATUS[code], [('Content-Type', 'application/json')])
+        if isinstance(body, dict):
+            return [json.dumps(body)]
+        return body             # Already an iterable of JSON text
+
+    @staticmethod
+    def _query(environ):
+        return dict((name, values[-1]) for name, values in
+                    urlparse.parse_qs(environ.get('QUERY_STRING', '')).items())
+
+    @staticmethod
+    def _body(environ):
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        return json.loads(environ['wsgi.input'].read(length)) if length else { }
+
+    def status(self, environ):
+        controller = self.daemon.controller
+        if controller.last_response is None:
+            return 503, { 'error': "No response from the controller yet" }
+        azimuth, elevation = controller.position()
+        return 200, { 'azimuth': azimuth,
+                      'elevation': elevation,
+                      'response': controller.last_response,
+                      'time': controller.last_response_time,
+                      'age': controller.clock.time() - controller.last_response_time,
+                      'queued': len(self.daemon.queue),
+                      'coalesced': self.daemon.queue.coalesced,
+                      'aborted': self.daemon.queue.aborted }
+
+    def telemetry(self, environ):
+        store = self.daemon.controller.telemetry
+        if store is None:
+            return 503, { 'error': "No telemetry is being kept" }
+        query = self._query(environ)
+        seconds = float(query.get('seconds', TELEMETRY_SECONDS))
+        limit = int(query.get('limit', TELEMETRY_LIMIT))
+        records = store.read(start=self.daemon.controller.clock.time() - seconds)[-limit:]
+        return 200, self._stream(records)
+
+    @staticmethod
+    def _stream(records):
+        """Yield records as a JSON list, STREAM_RECORDS at a time."""
+        names = records.dtype.names
+        yield '['
+        for start in range(0, len(records), STREAM_RECORDS):
+            chunk = records[start:start + STREAM_RECORDS]
+            rows = (json.dumps(dict(zip(names, record.tolist()))) for record in chunk)
+            yield (',' if start else '') + ','.join(rows)
+        yield ']'
+
+    def metrics(self, environ):
+        return 200, self.daemon.controller.metrics.render()
+
+    def move(self, environ):
+        request = self._body(environ)
+        azimuth, elevation = request.get('azimuth'), request.get('elevation')
+        speed = request.get('speed')
+        if azimuth is not None and elevation is not None:
+            op, args = 'move_to', [azimuth, elevation, speed]
+        elif azimuth is not None:
+            op, args = 'azimuth', [azimuth, speed]
+        elif elevation is not None:
+            op, args = 'elevation', [elevation, speed]
+        else:
+            raise ValueError("give an azimuth, an elevation or both")
+        return self._submit({ 'op': op, 'args': args })
+
+    def stop(self, environ):
+        return self._submit({ 'op': 'stop' })
+
+    def _submit(self, request):
+        reply = self.daemon.handle(request)
+        if not reply['ok']:
+            return 400, { 'error': reply['error'] }
+        return 202, { 'id': reply['id'], 'azimuth': reply['position'][0],
+                      'elevation': reply['position'][1] }
+
+class _Server(SocketServer.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+class _Handler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        logger.debug("%s %s", self.client_address[0], format % args)
+
+def make_status_server(daemon, host=HTTP_HOST, port=HTTP_PORT):
+    """Return a (threaded) WSGI server for daemon; call its serve_forever()."""
+    server = make_server(host, port, StatusApp(daemon), server_class=_Server,
+                         handler_class=_Handler)
+    logger.info("Serving status on http://%s:%d/", host, port)
+    return server
@@ -0,0 +1,127 @@
+"""Streaming analysis of heliostat sweep logs.
+
+Reads plain or gzipped logs in large chunks, finds the interesting
+lines with a single compiled pattern, and accumulates the azimuth
+offset seen at each (elevation, requested azimuth) into NumPy arrays.
+Many files are analysed in parallel worker processes and their results
+merged, giving the count, mean and spread of the offset in each cell.
+"""
+
+from __future__ import division
+
+import gzip
+import multiprocessing
+import re
+
+import numpy as np
+
+from heliostat import AZIMUTH_MAX, ELEVATION_MAX
+
+CHUNK_SIZE = 4 * 1024 * 1024    # Bytes read from a log at a time
+
+# One pattern for all three kinds of line we care about. Response lines
+# were logged as "AZ" by older versions of heliostat.py and as "SPAZ"
+# by newer ones.
+LINE = re.compile(r'MOVING AZIMUTH TO (?P<req_az>\d+)'
+                  r'|MOVING ELEVATION TO (?P<req_el>\d+)'
+                  r'|DEBUG \S+\(\d+\) (?:SP)?AZ (?P<az>\d+) EL (?P<el>\d+)')
+
+class SweepOffsets(object):
+    """Running count, sum and sum of squares of the azimuth offset
+    (actual - requested) for each [elevation, requested azimuth].
+    """
+    def __init__(self, shape=(ELEVATION_MAX + 1, AZIMUTH_MAX + 1)):
+        self.count = np.zeros(shape, dtype=np.int64)
+        self.total = np.zeros(shape)
+        self.total_sq = np.zeros(shape)
+        self.ignored = 0        # Samples outside the table
+
+    def add(self, elevations, azimuths, offsets):
+        elevations, azimuths, offsets = [np.asarray(values) for values in
+                                         (elevations, azimuths, offsets)]
+        inside = ((elevations >= 0) & (elevations < self.count.shape[0]) &
+                  (azimuths >= 0) & (azimuths < self.count.shape[1]))
+        self.ignored += int(np.sum(~inside))
+        cells = np.ravel_multi_index((elevations[inside], azimuths[inside]), self.count.shape)
+        size = self.count.size
+        self.count += np.bincount(cells, minlength=size).reshape(self.count.shape)
+        self.total += np.bincount(cells, offsets[inside], minlength=size).reshape(self.count.shape)
+        self.total_sq += np.bincount(cells, offsets[inside] ** 2,
+                                     minlength=size).reshape(self.count.shape)
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.total_sq += other.total_sq
+        self.ignored += other.ignored
+        return self
+
+    def mean(self):
+        """Mean offset per cell; NaN where there were no samples."""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.total / self.count
+
+    def std(self):
+        """Standard deviation of the offset per cell; NaN where there were no samples."""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            variance = self.total_sq / self.count - self.mean() ** 2
+        return np.sqrt(np.maximum(variance, 0))
+
+def _open_log(path):
+    return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+
+def _read_chunks(path):
+    """Yield the log as text chunks that end on a line boundary."""
+    with _open_log(path) as f:
+        carry = b''
+        while True:
+            block = f.read(CHUNK_SIZE)
+            if not block:
+                break
+            block = carry + block
+            cut = block.rfind(b'\n') + 1
+            carry = block[cut:]
+            yield block[:cut].decode('ascii', 'replace')
+        if carry:
+            yield carry.decode('ascii', 'replace')
+
+def analyse_log(path):
+    """Analyse one log file and return its SweepOffsets.
+
+    As in the original grok_sweep.py, responses only count while the
+    elevation is being swept, and are filed under the most recently
+    requested azimuth.
+    """
+    requested_az = None
+    adjusting_el = False
+    elevations, azimuths, offsets = [ ], [ ], [ ]
+
+    for chunk in _read_chunks(path):
+        for match in LINE.finditer(chunk):
+            req_az, req_el, az, el = match.groups()
+            if req_az is not None:
+                requested_az = int(req_az)
+                adjusting_el = False
+            elif req_el is not None:
+                adjusting_el = True
+            elif adjusting_el and requested_az is not None:
+                elevations.append(int(el))
+                azimuths.append(requested_az)
+                offsets.append(int(az) - requested_az)
+
+    result = SweepOffsets()
+    if offsets:
+        result.add(elevations, azimuths, offsets)
+    return result
+
+def analyse_logs(paths, processes=None):
+    """Analyse many logs in parallel and merge the results."""
+    if len(paths) == 1:
+        return analyse_log(paths[0])
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(analyse_log, paths)
+    finally:
+        pool.close()
+        pool.join()
+    return reduce(SweepOffsets.merge, results, SweepOffsets())
@@ -1,4 +1,5 @@
-from heliostat import Controller, AZIMUTH_MIN, AZIMUTH_MAX, ELEVATION_MIN, ELEVATION_MAX
+from daemon import DaemonClient
+from heliostat import AZIMUTH_MIN, AZIMUTH_MAX, ELEVATION_MIN, ELEVATION_MAX
 import argparse
 import logging
 
@@ -15,16 +16,20 @@ args = parser.parse_args()
 
 DEGREE_STEP = 3
 
+# Sweeps are in string-pot readings, and each move must finish before
+# the next. The "MOVING" notes go in the daemon's log, among the
+# responses, where sweep_analysis looks for them -- which are only
+# logged if the daemon runs with --log-level DEBUG.
+controller = DaemonClient(wait=True)
 try:
-    controller = Controller()
     moving_up = True
 
-    controller.azimuth(args.azimuth_min)
-    controller.elevation(args.elevation_min)
+    controller.azimuth(args.azimuth_min, raw=True)
+    controller.elevation(args.elevation_min, raw=True)
 
     for azimuth in xrange(args.azimuth_min, args.azimuth_max, DEGREE_STEP):
         logger.info("*** MOVING AZIMUTH TO %d", azimuth)
-        az, el = controller.azimuth(azimuth)
+        az, el = controller.azimuth(azimuth, raw=True, note="MOVING AZIMUTH TO {0}".format(azimuth))
 
         if moving_up:
             elevation = args.elevation_max
@@ -32,7 +37,8 @@ try:
             elevation = args.elevation_min
 
         logger.info("*** MOVING ELEVATION TO %d", elevation)
-        az, el = controller.elevation(elevation)
+        az, el = controller.elevation(elevation, raw=True,
+                                      note="MOVING ELEVATION TO {0}".format(elevation))
 
         moving_up = not moving_up
             
@@ -41,3 +47,4 @@ except KeyboardInterrupt:
     controller.stop()
 finally:
     controller.report_stats()
+    controller.close()
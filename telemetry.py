@@ -0,0 +1,101 @@
+"""Compact on-disk store for controller telemetry.
+
+Every decoded response is appended to a fixed-size, memory-mapped ring
+file, one column per field, so a year of readings takes bounded space
+and can be read back as NumPy arrays without parsing log files.
+
+File layout: a HEADER_SIZE-byte header followed by one block of
+`capacity` values per column, in COLUMNS order. Record i (counting from
+the first ever written) lives in slot i % capacity.
+"""
+
+import os
+
+import numpy as np
+
+MAGIC = b'HELIOTEL'
+VERSION = 1
+HEADER_SIZE = 64
+CAPACITY = 2 ** 22              # Records kept (about 90MB on disk)
+TELEMETRY_FILE = 'telemetry.dat'
+
+HEADER = np.dtype([('magic', 'S8'), ('version', '<u4'), ('pad', '<u4'),
+                   ('capacity', '<u8'), ('written', '<u8')])
+
+COLUMNS = [('time', '<f8'),     # Seconds since the epoch
+           ('azimuth', '<u2'),
+           ('elevation', '<u2'),
+           ('compass_azimuth', '<u2'),
+           ('temperature', '<f4'),
+           ('humidity', '<f4')]
+
+RECORD = np.dtype(COLUMNS)
+
+class TelemetryStore(object):
+    def __init__(self, path, capacity=CAPACITY, mode='r+'):
+        """Open the store at path, creating it with room for capacity
+        records if it doesn't exist. Use mode='r' to read a store that
+        another process is writing.
+        """
+        if not os.path.exists(path):
+            if mode == 'r':
+                raise IOError("No telemetry store at {0}".format(path))
+            self._create(path, capacity)
+
+        self.path = path
+        self.header = np.memmap(path, dtype=HEADER, mode=mode, shape=(1,))
+        if self.header['magic'][0] != MAGIC or self.header['version'][0] != VERSION:
+            raise ValueError("{0} is not a version {1} telemetry store".format(path, VERSION))
+        self.capacity = int(self.header['capacity'][0])
+
+        self.columns = { }
+        offset = HEADER_SIZE
+        for name, dtype in COLUMNS:
+            self.columns[name] = np.memmap(path, dtype=dtype, mode=mode,
+                                           offset=offset, shape=(self.capacity,))
+            offset += self.capacity * np.dtype(dtype).itemsize
+
+    @staticmethod
+    def _create(path, capacity):
+        header = np.zeros(1, dtype=HEADER)
+        header['magic'] = MAGIC
+        header['version'] = VERSION
+        header['capacity'] = capacity
+        with open(path, 'wb') as f:
+            f.write(header.tostring().ljust(HEADER_SIZE, b'\0'))
+            f.truncate(HEADER_SIZE + capacity * RECORD.itemsize)
+
+    def __len__(self):
+        return int(min(self.header['written'][0], self.capacity))
+
+    def append(self, response, when):
+        """Store a decoded response received at time when."""
+        slot = int(self.header['written'][0] % self.capacity)
+        self.columns['time'][slot] = when
+        for name, dtype in COLUMNS[1:]:
+            self.columns[name][slot] = response[name]
+        self.header['written'] += 1
+
+    def flush(self):
+        for column in self.columns.values():
+            column.flush()
+        self.header.flush()
+
+    def read(self, start=None, end=None):
+        """Return the records with start <= time < end (either bound
+        may be omitted), oldest first, as a structured array with one
+        field per column.
+        """
+        written = int(self.header['written'][0])
+        count = len(self)
+        slots = np.arange(written - count, written) % self.capacity
+
+        times = self.columns['time'][slots]
+        low = 0 if start is None else np.searchsorted(times, start, side='left')
+        high = count if end is None else np.searchsorted(times, end, side='left')
+        slots = slots[low:high]
+
+        records = np.empty(len(slots), dtype=RECORD)
+        for name, dtype in COLUMNS:
+            records[name] = self.columns[name][slots]
+        return records
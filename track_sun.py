@@ -1,15 +1,24 @@
 # -*- coding: utf-8 -*-
 
-import time
 import astral
+import datetime
+import math
 
-from heliostat import CompassController
+import numpy as np
+
+from ephemeris import DailyEphemeris, RESOLUTION
+from daemon import DaemonClient, PRIORITY_TRACKING
+from heliostat import system_clock
 from solar_finders import AstralSolarFinder, EmpiricalSolarFinder
 
 import logging
 logger = logging.getLogger(__name__)
 
-SLEEP_TIME = 60                 # Sleep time in seconds
+SLEEP_TIME_MAX = 3600           # Longest sleep (seconds) waiting for the sun to move
+LEAD_FRACTION = 0.5             # Aim this far through the next hold interval when leading
+LEAD_TIME_MAX = 600             # Never aim further ahead than this (seconds)
+AIM_HORIZON = 3600              # Look no further ahead than this to aim past the target (seconds)
+COS_ELEVATION_MIN = 0.2         # Widen the azimuth deadband no more than 1/this
 
 ## Data taken by Jeff Dailey, 21-Aug-2012.
 jeffs_data = (
@@ -31,20 +40,113 @@ jeffs_data = (
     ('16:30', 225, 66),
     ('17:00', 228, 63) )
 
-def mirror_elevation(solar_elevation):
-    """Convert solar elevation to the elevation value for the mirror."""
-    return 90 - ((90 - solar_elevation) / 2)
-
-def track(controller, finder):
+class TrackingPolicy(object):
+    """When and where to move each axis to follow the target.
+
+    With no deadband (the default) an axis moves whenever its
+    whole-degree target changes, straight to the target. With one, an
+    axis is left alone until its target is more than the deadband away,
+    and is then sent on past the target, to where it will be a deadband
+    further on (or as far as it gets within AIM_HORIZON, e.g. when the
+    elevation peaks). So the error swings from one side of the band to
+    the other and each move does the work of several.
+
+    An error budget (degrees of pointing error) sets both deadbands:
+    it is split evenly between the axes, and the azimuth's share is
+    widened by 1/cos(mirror elevation), since an error in azimuth tips
+    the mirror less the higher it points.
+    """
+    def __init__(self, budget=None, azimuth=0.0, elevation=0.0, horizon=AIM_HORIZON):
+        self.budget = budget
+        self.azimuth = azimuth
+        self.elevation = elevation
+        self.horizon = horizon
+
+    def __str__(self):
+        if self.budget is not None:
+            return "budget {0:g}".format(self.budget)
+        return "deadband AZ {0:g} EL {1:g}".format(self.azimuth, self.elevation)
+
+    def deadbands(self, mirror_elevation):
+        """Azimuth and mirror elevation deadbands (degrees) at the given mirror elevation."""
+        if self.budget is None:
+            return self.azimuth, self.elevation
+        share = self.budget / math.sqrt(2)
+        cos_elevation = max(math.cos(math.radians(mirror_elevation)), COS_ELEVATION_MIN)
+        return share / cos_elevation, share
+
+    def plan(self, ephemeris, when, current, target):
+        """Where to send the mirror, given where it is (current) and the
+        (azimuth, mirror elevation) target at when; an axis that should
+        stay put is given its current value.
+        """
+        bands = self.deadbands(target[1])
+        new = list(current)
+        upcoming = None
+        for axis, row in ((0, 0), (1, 2)):
+            if abs(target[axis] - current[axis]) <= bands[axis]:
+                continue
+            if not bands[axis]:
+                new[axis] = target[axis]
+                continue
+            if upcoming is None:
+                upcoming = ephemeris.upcoming(when, self.horizon)
+            new[axis] = self._aim(upcoming[row], target[axis], bands[axis])
+        return tuple(new)
+
+    @staticmethod
+    def _aim(values, target, band):
+        """The first of values a band beyond target or, if they turn
+        back first, the furthest they get.
+        """
+        offsets = np.abs(values.astype(int) - target)
+        beyond = np.nonzero(offsets >= band)[0]
+        returning = np.nonzero(np.diff(offsets) < 0)[0]
+        if len(beyond) and (not len(returning) or beyond[0] <= returning[0]):
+            return int(values[beyond[0]])
+        end = returning[0] if len(returning) else len(values) - 1
+        return int(values[np.argmax(offsets[:end + 1])])
+
+def track(controller, finder, clock=system_clock, until=None, resolution=RESOLUTION, lead=None,
+          policy=None):
+    """Keep the mirror on the sun, forever or until the clock reads
+    until (seconds since the epoch). Resolution is that of the daily
+    ephemeris, in seconds.
+
+    By default the mirror is sent to where the sun is now, so it lands
+    behind it. With lead (a fraction, e.g. LEAD_FRACTION), it is sent
+    to where the sun will be that fraction of the way through the time
+    it will hold still after the move is predicted to finish.
+
+    Policy (a TrackingPolicy) decides when an axis is far enough off
+    to move and where to send it; by default, on any change, to the
+    target.
+    """
+    policy = policy if policy is not None else TrackingPolicy()
     cur_azimuth, cur_mirror_elevation = controller.stop()
     logger.info("Current AZ {0}, MEL {1}".format(cur_azimuth, cur_mirror_elevation))
 
-    while True:
-        azimuth, solar_elevation = controller.clamp_azimuth_elevation(*finder.find())
+    ephemeris = DailyEphemeris(finder, controller.azimuth_elevation_limits, resolution=resolution)
+
+    while until is None or clock.time() < until:
+        ephemeris.refresh()
+        now = clock.now(ephemeris.tz)
+        ahead = 0.0             # Seconds we aim ahead of the sun
+        if lead is not None:
+            azimuth, _, new_mirror_elevation = ephemeris.target(now)
+            ahead = controller.move_time(azimuth, new_mirror_elevation)
+            ahead += lead * ephemeris.hold(now + datetime.timedelta(seconds=ahead))
+            ahead = min(ahead, LEAD_TIME_MAX)
+            logger.info("Leading the sun by %.1fs", ahead)
+
+        when = now + datetime.timedelta(seconds=ahead)
+        azimuth, solar_elevation, new_mirror_elevation = ephemeris.target(when)
         logger.info("AZ %d SEL %d", azimuth, solar_elevation)
-        new_mirror_elevation = mirror_elevation(solar_elevation)
         logger.info("AZ %d MEL %d", azimuth, new_mirror_elevation)
-        
+        azimuth, new_mirror_elevation = policy.plan(ephemeris, when,
+                                                    (cur_azimuth, cur_mirror_elevation),
+                                                    (azimuth, new_mirror_elevation))
+
         if (cur_azimuth != azimuth or cur_mirror_elevation != new_mirror_elevation):
             logger.info("Sun moved to AZ {0}, SEL {1}".format(azimuth, solar_elevation))
 
@@ -53,34 +155,44 @@ def track(controller, finder):
             # unnecessary movement of the mirror due to mapping the
             # string-pot azimuth back to a compass azimuth. Instead,
             # we assume the heliostat did the Right Thing.
-            if cur_azimuth != azimuth:
+            if cur_azimuth != azimuth and cur_mirror_elevation != new_mirror_elevation:
+                controller.move_to(azimuth, new_mirror_elevation)
+                cur_azimuth, cur_mirror_elevation = azimuth, new_mirror_elevation
+
+            elif cur_azimuth != azimuth:
                 controller.azimuth(azimuth)
                 cur_azimuth = azimuth
 
-            if cur_mirror_elevation != new_mirror_elevation:
+            else:
                 controller.elevation(new_mirror_elevation)
                 cur_mirror_elevation = new_mirror_elevation
 
         else:
             logger.info("Sun in same location.")
 
-        logger.info("Sleeping %ds", SLEEP_TIME)
-        time.sleep(SLEEP_TIME)
+        # Sleep until the target next changes (but wake now and then,
+        # so the ephemeris is refreshed if the limits or finder change).
+        now = clock.now(ephemeris.tz)
+        sleep_time = min(ephemeris.next_change(now + datetime.timedelta(seconds=ahead)),
+                         SLEEP_TIME_MAX)
+        logger.info("Sleeping %.1fs", sleep_time)
+        clock.sleep(sleep_time)
 
 
-controller = CompassController()
+if __name__ == '__main__':
+    controller = DaemonClient(priority=PRIORITY_TRACKING)
 
-upland = astral.Location(("Upland", "USA",
-                          """40°27'22"N""",
-                          """85°29'43"W""",
-                          "US/Eastern"))
+    upland = astral.Location(("Upland", "USA",
+                              """40°27'22"N""",
+                              """85°29'43"W""",
+                              "US/Eastern"))
 
-finder = AstralSolarFinder(upland)
+    finder = AstralSolarFinder(upland)
 
-try:
-    track(controller, finder)
-except KeyboardInterrupt:
-    logger.warning("Caught keyboard interrupt; sending stop comand.")
-    controller.stop()
-finally:
-    controller.report_stats()
+    try:
+        track(controller, finder)
+    except KeyboardInterrupt:
+        logger.warning("Caught keyboard interrupt; sending stop comand.")
+        controller.stop()
+    finally:
+        controller.report_stats()